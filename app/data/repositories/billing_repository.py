@@ -4,12 +4,15 @@ Pure CRUD operations for billing transactions.
 Repository pattern implementation with clean separation of data access.
 """
 import logging
-from typing import Any, Dict, List, Optional, Protocol
-from uuid import UUID
-from datetime import datetime
+import threading
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional, Protocol, Tuple, Union
+from uuid import UUID, uuid4
+from datetime import date, datetime, time, timedelta, timezone
 
 from app.models.billing import TransactionRecord
-from app.core.exceptions import (
+from app.core.exceptions import ValidationError, InsufficientCreditsError
+from app.api.exceptions import (
     TransactionNotFoundError,
     DuplicateTransactionError,
     InvalidTransactionTypeError
@@ -40,10 +43,24 @@ class QueryResponse(Protocol):
     count: Optional[int]
 
 class BillingRepository:
-    """Pure CRUD operations for billing transactions - no business logic"""
+    """
+    Pure CRUD operations for billing transactions - no business logic.
+
+    The async methods read and write the credit_transactions table. The
+    synchronous credit ledger methods (create_credit_transaction,
+    add_credits, deduct_credits, get_user_balance, ...) work on an
+    in-memory ledger instead: its entries and balances are process-local,
+    are not persisted, and are not visible to the table-backed methods.
+    """
     
     # Valid transaction types as defined in database schema
-    VALID_TRANSACTION_TYPES = {"purchase", "usage", "refund", "bonus", "adjustment"}
+    VALID_TRANSACTION_TYPES = frozenset({"purchase", "usage", "refund", "bonus", "adjustment"})
+    # Ledger sign rules: these types add credits, the rest remove them
+    CREDIT_TRANSACTION_TYPES = frozenset({"purchase", "bonus", "adjustment"})
+    VALID_TRANSACTION_STATUSES = frozenset({"pending", "completed", "failed", "cancelled"})
+    # Expected amount sign per type, built once so validation is a single lookup
+    _AMOUNT_SIGN = dict.fromkeys(CREDIT_TRANSACTION_TYPES, 1)
+    _AMOUNT_SIGN.update(dict.fromkeys(VALID_TRANSACTION_TYPES - CREDIT_TRANSACTION_TYPES, -1))
     
     def __init__(self, table: Optional[DatabaseTable] = None):
         """
@@ -57,6 +74,19 @@ class BillingRepository:
             from app.data.database import db
             self.table = db.table("credit_transactions")
 
+        # In-memory credit ledger, keyed by transaction id in insertion order
+        self._credit_transactions: Dict[str, Dict[str, Any]] = {}
+        # Running balance per user_id, kept in step with completed entries
+        self._balances: Dict[UUID, int] = {}
+        # user_id -> that user's transaction ids, oldest first
+        self._user_transaction_ids: Dict[UUID, List[str]] = {}
+        # Unique stripe_payment_intent_id -> transaction id
+        self._stripe_intent_ids: Dict[str, str] = {}
+        # Ids of pending entries in creation order (dict used as an ordered set)
+        self._pending_ids: Dict[str, None] = {}
+        # Guards balance check-then-write so deductions cannot interleave
+        self._ledger_lock = threading.Lock()
+
     async def create_transaction(
         self,
         user_id: UUID,
@@ -240,6 +270,8 @@ class BillingRepository:
         metadata: Dict[str, Any]
     ) -> TransactionRecord:
         """Update transaction metadata (one of the few update operations allowed)"""
+        if not isinstance(metadata, dict):
+            raise TypeError("metadata must be a dict")
         try:
             # First verify transaction exists
             existing = await self.get_transaction_by_id(transaction_id)
@@ -379,6 +411,486 @@ class BillingRepository:
             logger.error(f"Failed to delete transaction {transaction_id}: {e}")
             raise Exception(f"Failed to delete transaction: {e}")
 
+    # --- Credit Ledger Methods (in-memory, process-local) ---
+
+    @staticmethod
+    def _parse_user_id(user_id: Any) -> UUID:
+        """Normalize a UUID or UUID string once; the ledger stores and indexes UUIDs"""
+        if isinstance(user_id, UUID):
+            return user_id
+        try:
+            return UUID(str(user_id))
+        except ValueError:
+            raise ValidationError(f"invalid user_id: {user_id}")
+
+    @staticmethod
+    def _ledger_time(value: Union[date, datetime], end_of_day: bool = False) -> str:
+        """
+        Render a query bound in the ledger's naive-UTC ISO format.
+
+        A bare date means midnight; with end_of_day it means the following
+        midnight, used as an exclusive upper bound so the day is covered by
+        the half-open range [day, day + 1).
+        """
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time.min)
+            if end_of_day:
+                value += timedelta(days=1)
+        elif value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+
+    @staticmethod
+    def _export_credit_transaction(record: Dict[str, Any], user_id: Optional[str] = None) -> Dict[str, Any]:
+        """Copy a stored record for callers, rendering user_id as a string (pass it to reuse one)"""
+        row = record.copy()
+        row["user_id"] = user_id if user_id is not None else str(row["user_id"])
+        return row
+
+    def _build_credit_transaction(
+        self,
+        transaction_data: Dict[str, Any],
+        transaction_type: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Validate a ledger entry and build its record in the same pass.
+
+        Each input key is read once; ValidationError is raised on the first
+        problem found. transaction_type, if given, overrides the input's.
+        Timestamps are left unset until the record is stored.
+        """
+        user_id = transaction_data.get("user_id")
+        if not user_id:
+            raise ValidationError("user_id is required")
+        description = transaction_data.get("description")
+        if not description:
+            raise ValidationError("description is required")
+
+        if transaction_type is None:
+            transaction_type = transaction_data.get("transaction_type")
+        sign = self._AMOUNT_SIGN.get(transaction_type)
+        if sign is None:
+            raise ValidationError(f"Invalid transaction type: {transaction_type}")
+
+        amount = transaction_data.get("amount")
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount == 0:
+            raise ValidationError("amount must be a non-zero integer")
+        if amount * sign < 0:
+            direction = "positive" if sign > 0 else "negative"
+            raise ValidationError(f"{transaction_type} amount must be {direction}")
+
+        status = transaction_data.get("status", "completed")
+        if status not in self.VALID_TRANSACTION_STATUSES:
+            raise ValidationError(f"Invalid transaction status: {status}")
+
+        return {
+            "id": str(uuid4()),
+            "user_id": self._parse_user_id(user_id),
+            "amount": amount,
+            "transaction_type": transaction_type,
+            "description": description,
+            "status": status,
+            "stripe_payment_intent_id": transaction_data.get("stripe_payment_intent_id"),
+            "metadata": dict(transaction_data.get("metadata") or {}),
+            "created_at": None,
+            "updated_at": None,
+        }
+
+    def _store_credit_transaction(self, record: Dict[str, Any]) -> None:
+        """
+        Insert a record, index it, and fold it into the running balance if completed.
+
+        Called with _ledger_lock held. The record is stamped here rather than
+        when it is built, so each user's index stays in created_at order even
+        when writers race for the lock.
+        """
+        intent_id = record["stripe_payment_intent_id"]
+        if intent_id is not None and intent_id in self._stripe_intent_ids:
+            raise DuplicateTransactionError(intent_id)
+
+        uid = record["user_id"]
+        record["created_at"] = record["updated_at"] = datetime.utcnow().isoformat()
+        self._credit_transactions[record["id"]] = record
+        self._user_transaction_ids.setdefault(uid, []).append(record["id"])
+        if intent_id is not None:
+            self._stripe_intent_ids[intent_id] = record["id"]
+        if record["status"] == "pending":
+            self._pending_ids[record["id"]] = None
+        if record["status"] == "completed":
+            self._balances[uid] = self._balances.get(uid, 0) + record["amount"]
+
+    def create_credit_transaction(self, transaction_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Record a credit ledger entry (positive amounts add, negative remove)"""
+        record = self._build_credit_transaction(transaction_data)
+        with self._ledger_lock:
+            self._store_credit_transaction(record)
+        return self._export_credit_transaction(record)
+
+    def find_by_stripe_intent(self, stripe_payment_intent_id: str) -> Optional[Dict[str, Any]]:
+        """Look up the ledger entry for a Stripe payment intent, if any"""
+        txn_id = self._stripe_intent_ids.get(stripe_payment_intent_id)
+        if txn_id is None:
+            return None
+        return self._export_credit_transaction(self._credit_transactions[txn_id])
+
+    def process_stripe_payment(self, payment_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Record a completed Stripe payment as a purchase, idempotently.
+
+        The duplicate check and the insert happen under one lock, so a
+        retried webhook for the same payment intent returns the original
+        transaction with credits_added 0 instead of crediting twice.
+        """
+        intent_id = payment_data.get("stripe_payment_intent_id")
+        if not intent_id:
+            raise ValidationError("stripe_payment_intent_id is required")
+
+        credits = payment_data.get("credits_purchased")
+        package = payment_data.get("package")
+        record = self._build_credit_transaction({
+            "user_id": payment_data.get("user_id"),
+            "amount": credits,
+            "transaction_type": "purchase",
+            "description": f"Credit purchase - {package}" if package else "Credit purchase",
+            "stripe_payment_intent_id": intent_id,
+            "metadata": {
+                "package": package,
+                "amount_paid": payment_data.get("amount_paid"),
+                "currency": payment_data.get("currency"),
+            },
+        })
+
+        with self._ledger_lock:
+            existing_id = self._stripe_intent_ids.get(intent_id)
+            if existing_id is not None:
+                return {"success": True, "credits_added": 0, "transaction_id": existing_id, "duplicate": True}
+            self._store_credit_transaction(record)
+
+        return {"success": True, "credits_added": credits, "transaction_id": record["id"], "duplicate": False}
+
+    def get_pending_transactions(self) -> List[Dict[str, Any]]:
+        """Pending entries, oldest first, read from the pending index"""
+        return [
+            self._export_credit_transaction(self._credit_transactions[txn_id])
+            for txn_id in self._pending_ids
+        ]
+
+    def update_transaction_status(self, transaction_id: str, status: str) -> bool:
+        """
+        Move an entry to a new status, keeping the balance and pending index in step.
+
+        Completing a deduction that the balance can no longer cover raises
+        InsufficientCreditsError and leaves the entry unchanged.
+        """
+        if status not in self.VALID_TRANSACTION_STATUSES:
+            raise ValidationError(f"Invalid transaction status: {status}")
+
+        with self._ledger_lock:
+            record = self._credit_transactions.get(transaction_id)
+            if record is None:
+                raise TransactionNotFoundError(transaction_id)
+            if record["status"] == status:
+                return True
+
+            uid = record["user_id"]
+            amount = record["amount"]
+            balance = self._balances.get(uid, 0)
+            if record["status"] == "completed":
+                balance -= amount
+            if status == "completed":
+                balance += amount
+            if balance < 0:
+                raise InsufficientCreditsError(
+                    f"Insufficient credits - balance: {self._balances.get(uid, 0)}, "
+                    f"requested: {abs(amount)}",
+                    balance=self._balances.get(uid, 0),
+                    requested=abs(amount)
+                )
+
+            self._balances[uid] = balance
+            if status == "pending":
+                self._pending_ids[transaction_id] = None
+            else:
+                self._pending_ids.pop(transaction_id, None)
+            record["status"] = status
+            record["updated_at"] = datetime.utcnow().isoformat()
+        return True
+
+    def get_user_balance(self, user_id: UUID) -> int:
+        """Current credit balance from the running total (no ledger scan)"""
+        return self._balances.get(self._parse_user_id(user_id), 0)
+
+    def deduct_credits(self, user_id: UUID, amount: int, description: str) -> bool:
+        """Deduct credits as a usage entry, raising if the balance is too low"""
+        if amount <= 0:
+            raise ValidationError("amount must be positive")
+        if not description:
+            raise ValidationError("description is required")
+
+        record = self._build_credit_transaction({
+            "user_id": user_id,
+            "amount": -amount,
+            "transaction_type": "usage",
+            "description": description,
+        })
+
+        # Check and write under one lock: the balance read is the one the write applies to
+        with self._ledger_lock:
+            balance = self._balances.get(record["user_id"], 0)
+            if amount > balance:
+                raise InsufficientCreditsError(
+                    f"Insufficient credits - balance: {balance}, requested: {amount}",
+                    balance=balance,
+                    requested=amount
+                )
+            self._store_credit_transaction(record)
+        return True
+
+    def add_credits(
+        self,
+        user_id: UUID,
+        amount: int,
+        description: str,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """
+        Add credits to a user's balance as a bonus ledger entry.
+
+        metadata is stored as given and never indexed; Stripe-paid credits
+        go through process_stripe_payment instead.
+        """
+        if amount <= 0:
+            raise ValidationError("amount must be positive")
+        if not description:
+            raise ValidationError("description is required")
+
+        self.create_credit_transaction({
+            "user_id": user_id,
+            "amount": amount,
+            "transaction_type": "bonus",
+            "description": description,
+            "metadata": metadata or {},
+        })
+        return True
+
+    def get_transaction_history(
+        self,
+        user_id: UUID,
+        transaction_type: Optional[str] = None,
+        limit: Optional[int] = None,
+        start_date: Optional[Union[date, datetime]] = None,
+        end_date: Optional[Union[date, datetime]] = None,
+        before: Optional[Tuple[str, str]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        A user's ledger entries, newest first.
+
+        Dates bound the range as [start_date, end_date]; pass plain dates
+        to get whole days as a half-open [start, end + 1 day) range. Paging
+        is keyset-based: pass the (created_at, id) of the last row of the
+        previous page as `before`; a cursor that does not name one of this
+        user's rows raises ValidationError. Both range ends are found by binary
+        search on the user's time-ordered index, so a page costs
+        O(log n + page size) however deep it is.
+        """
+        uid = self._parse_user_id(user_id)
+        ids = self._user_transaction_ids.get(uid, [])
+        records = self._credit_transactions
+
+        def created_at(txn_id: str) -> str:
+            return records[txn_id]["created_at"]
+
+        hi = len(ids)
+        if isinstance(end_date, datetime):
+            hi = bisect_right(ids, self._ledger_time(end_date), key=created_at)
+        elif end_date is not None:
+            hi = bisect_left(ids, self._ledger_time(end_date, end_of_day=True), key=created_at)
+        if before is not None:
+            before_created_at, before_id = before
+            tie_end = bisect_right(ids, before_created_at, hi=hi, key=created_at)
+            tie_start = bisect_left(ids, before_created_at, hi=tie_end, key=created_at)
+            # Rows sharing the cursor's timestamp are ordered by insertion
+            for pos in range(tie_start, tie_end):
+                if ids[pos] == before_id:
+                    hi = pos
+                    break
+            else:
+                raise ValidationError(f"Unknown history cursor: {before_id}")
+        lo = 0
+        if start_date is not None:
+            lo = bisect_left(ids, self._ledger_time(start_date), hi=hi, key=created_at)
+
+        # Every row belongs to this user: format the id once per page
+        uid_str = str(uid)
+        history = []
+        for pos in range(hi - 1, lo - 1, -1):
+            record = records[ids[pos]]
+            if transaction_type and record["transaction_type"] != transaction_type:
+                continue
+            history.append(self._export_credit_transaction(record, uid_str))
+            if limit is not None and len(history) >= limit:
+                break
+        return history
+
+    def get_billing_summary(self, user_id: UUID) -> Dict[str, Any]:
+        """Balance, purchase/usage totals and last activity dates in one pass"""
+        uid = self._parse_user_id(user_id)
+        total_purchased = 0
+        total_used = 0
+        last_purchase_date = None
+        last_usage_date = None
+        transaction_ids = self._user_transaction_ids.get(uid, [])
+
+        for txn_id in transaction_ids:
+            record = self._credit_transactions[txn_id]
+            if record["status"] != "completed":
+                continue
+            if record["transaction_type"] == "purchase":
+                total_purchased += record["amount"]
+                last_purchase_date = record["created_at"]
+            elif record["transaction_type"] == "usage":
+                total_used -= record["amount"]
+                last_usage_date = record["created_at"]
+
+        return {
+            "user_id": str(uid),
+            "current_balance": self._balances.get(uid, 0),
+            "total_purchased": total_purchased,
+            "total_used": total_used,
+            "total_transactions": len(transaction_ids),
+            "last_purchase_date": last_purchase_date,
+            "last_usage_date": last_usage_date,
+        }
+
+    def get_usage_analytics(self, user_id: UUID, days: int = 30) -> Dict[str, Any]:
+        """
+        Usage totals over the last `days` days, bucketed per calendar day.
+
+        Walks the user's index newest-first and stops at the window edge,
+        accumulating straight into the day buckets, so the work and the
+        result are bounded by the window rather than the user's history.
+        """
+        uid = self._parse_user_id(user_id)
+        cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        usage_by_day: Dict[str, Dict[str, int]] = {}
+        total_used = 0
+        total_count = 0
+
+        for txn_id in reversed(self._user_transaction_ids.get(uid, [])):
+            record = self._credit_transactions[txn_id]
+            if record["created_at"] < cutoff:
+                break
+            if record["transaction_type"] != "usage" or record["status"] != "completed":
+                continue
+            bucket = usage_by_day.setdefault(
+                record["created_at"][:10], {"credits_used": 0, "transactions": 0}
+            )
+            bucket["credits_used"] -= record["amount"]
+            bucket["transactions"] += 1
+            total_used -= record["amount"]
+            total_count += 1
+
+        return {
+            "user_id": str(uid),
+            "period_days": days,
+            "total_credits_used": total_used,
+            "total_usage_transactions": total_count,
+            "average_daily_usage": total_used / days if days > 0 else 0,
+            "usage_by_day": usage_by_day,
+        }
+
+    def get_low_balance_users(self, threshold: int) -> List[Dict[str, Any]]:
+        """Users whose balance is below threshold, read from the running balances"""
+        return [
+            {"user_id": str(uid), "balance": balance}
+            for uid, balance in self._balances.items()
+            if balance < threshold
+        ]
+
+    def _store_batch(self, records: List[Dict[str, Any]], check_balances: bool) -> None:
+        """
+        Write already-built records as one all-or-nothing batch.
+
+        With check_balances, each user's net completed change is checked
+        against their balance first. Stripe intent ids are checked against
+        the index and within the batch before anything is stored. Records
+        are then stamped with one timestamp under the lock and written in
+        bulk: the per-user index is extended and each balance adjusted once
+        per user rather than once per record.
+        """
+        ids_by_user: Dict[UUID, List[str]] = {}
+        deltas: Dict[UUID, int] = {}
+        intent_ids: Dict[str, str] = {}
+        pending_ids = []
+        for record in records:
+            uid = record["user_id"]
+            ids_by_user.setdefault(uid, []).append(record["id"])
+            if record["status"] == "completed":
+                deltas[uid] = deltas.get(uid, 0) + record["amount"]
+            elif record["status"] == "pending":
+                pending_ids.append(record["id"])
+            intent_id = record["stripe_payment_intent_id"]
+            if intent_id is not None:
+                if intent_id in intent_ids:
+                    raise DuplicateTransactionError(intent_id)
+                intent_ids[intent_id] = record["id"]
+
+        with self._ledger_lock:
+            if check_balances:
+                for uid, delta in deltas.items():
+                    if delta < 0:
+                        balance = self._balances.get(uid, 0)
+                        if balance + delta < 0:
+                            raise InsufficientCreditsError(
+                                f"Insufficient credits - balance: {balance}, requested: {-delta}",
+                                balance=balance,
+                                requested=-delta
+                            )
+            for intent_id in intent_ids:
+                if intent_id in self._stripe_intent_ids:
+                    raise DuplicateTransactionError(intent_id)
+
+            now = datetime.utcnow().isoformat()
+            for record in records:
+                record["created_at"] = record["updated_at"] = now
+            self._credit_transactions.update((r["id"], r) for r in records)
+            for uid, ids in ids_by_user.items():
+                self._user_transaction_ids.setdefault(uid, []).extend(ids)
+            for uid, delta in deltas.items():
+                self._balances[uid] = self._balances.get(uid, 0) + delta
+            self._stripe_intent_ids.update(intent_ids)
+            self._pending_ids.update(dict.fromkeys(pending_ids))
+
+    def bulk_create_transactions(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Batch form of create_credit_transaction: every row is validated before
+        any is written, and all share one timestamp. Returns the created rows.
+        """
+        records = [self._build_credit_transaction(row) for row in rows]
+        self._store_batch(records, check_balances=False)
+        return [self._export_credit_transaction(r) for r in records]
+
+    def bulk_credit_operations(self, operations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Apply many balance changes as one batch.
+
+        Every operation is validated and each user's net change is checked
+        against their balance before anything is written, so the batch either
+        lands in full or not at all. Operations without a transaction_type
+        default to usage (negative) or adjustment (positive).
+        """
+        records = []
+        for op in operations:
+            transaction_type = op.get("transaction_type")
+            if not transaction_type:
+                amount = op.get("amount")
+                is_int = isinstance(amount, int) and not isinstance(amount, bool)
+                transaction_type = "usage" if is_int and amount < 0 else "adjustment"
+            records.append(self._build_credit_transaction(op, transaction_type))
+
+        self._store_batch(records, check_balances=True)
+        return [{"success": True, "id": r["id"]} for r in records]
+
     # --- Health Check Methods ---
     
     async def health_check(self) -> Dict[str, Any]:
@@ -414,6 +926,15 @@ class BillingRepository:
     def create_for_testing(cls, mock_table: DatabaseTable) -> "BillingRepository":
         """Factory method for creating repository with mock table for testing"""
         return cls(table=mock_table)
+
+    def reset_ledger(self) -> None:
+        """Drop all in-memory ledger state so one instance can be reused across tests"""
+        with self._ledger_lock:
+            self._credit_transactions.clear()
+            self._balances.clear()
+            self._user_transaction_ids.clear()
+            self._stripe_intent_ids.clear()
+            self._pending_ids.clear()
     
     def _handle_response(self, response, operation: str = "database operation"):
         """
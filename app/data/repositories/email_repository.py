@@ -1,8 +1,31 @@
+import heapq
+import re
+from dataclasses import replace
 from datetime import datetime, timedelta
+from itertools import repeat
 from uuid import uuid4
 from typing import Any, Dict, List, Optional, Tuple
 
 from app.core.exceptions import ValidationError
+from app.models.email_processing import EmailProcessingRecord
+
+# Gmail message ids never contain whitespace; compiled once for the batch paths
+_MESSAGE_ID_INVALID_RE = re.compile(r"\s")
+
+# How long a discovery idempotency key replays its first response
+_IDEMPOTENCY_WINDOW = timedelta(hours=24)
+
+# Stats for a user with no records (user_id is filled in per call)
+_ZERO_STATS: Dict[str, Any] = {
+    "total_discovered": 0,
+    "total_processed": 0,
+    "total_successful": 0,
+    "total_failed": 0,
+    "total_pending": 0,
+    "success_rate": 0.0,
+    "total_credits_used": 0,
+    "average_processing_time": 0.0,
+}
 
 
 class EmailRepository:
@@ -12,112 +35,292 @@ class EmailRepository:
     - Processing start and completion
     - Retries and timeouts
     - Stats and cleanup
+
+    Records are immutable EmailProcessingRecord objects: every state change
+    stores a new record, so reads hand out stored records without copying.
     """
 
     def __init__(self):
         # Records stored by internal ID
-        self._records: Dict[str, Dict[str, Any]] = {}
+        self._records: Dict[str, EmailProcessingRecord] = {}
         # Index mapping (user_id, message_id) -> record_id
         self._index: Dict[Tuple[str, str], str] = {}
+        # Per-user index: user_id -> {record_id: record}, so per-user reads
+        # never walk other users' records
+        self._user_records: Dict[str, Dict[str, EmailProcessingRecord]] = {}
+        # Per-user records currently in "discovered" status (the work queue)
+        self._user_discovered: Dict[str, Dict[str, EmailProcessingRecord]] = {}
+        # Per-user records discovered more than once (discovery_count > 1)
+        self._user_duplicates: Dict[str, Dict[str, EmailProcessingRecord]] = {}
+        # Memoized get_processing_stats results, dropped on any write that
+        # changes the user's counts, so reads between writes are O(1)
+        self._stats_cache: Dict[str, Dict[str, Any]] = {}
+        # Min-heap of (processing_completed_at, record_id) for finished records,
+        # so cleanup pops only expired entries. Entries are checked on pop; ones
+        # left behind by retries or deletions are discarded then.
+        self._finished_heap: List[Tuple[datetime, str]] = []
+        # Records currently in "processing" status (record_id -> record), so
+        # stale-job sweeps only look at in-flight work
+        self._processing: Dict[str, EmailProcessingRecord] = {}
+        # Discovery responses by user_id -> idempotency_key -> (seen_at, records)
+        self._idempotency: Dict[str, Dict[str, Tuple[datetime, List[EmailProcessingRecord]]]] = {}
         # Default maximum retries
         self._default_max_retries = 3
 
+    def _validate_message_id(self, message_id: str) -> None:
+        if not message_id:
+            raise ValidationError("message_id cannot be empty")
+        if _MESSAGE_ID_INVALID_RE.search(message_id):
+            raise ValidationError("invalid message_id format")
+
+    def _put(
+        self,
+        rec: EmailProcessingRecord,
+        old: Optional[EmailProcessingRecord] = None,
+    ) -> EmailProcessingRecord:
+        """
+        Store a new or replacement record and keep every index in step with
+        its status. `old` is the record it replaces, if any.
+        """
+        rid = rec.id
+        uid = rec.user_id
+        self._records[rid] = rec
+        self._user_records.setdefault(uid, {})[rid] = rec
+
+        if rec.status == "discovered":
+            self._user_discovered.setdefault(uid, {})[rid] = rec
+        elif old is not None and old.status == "discovered":
+            discovered = self._user_discovered[uid]
+            del discovered[rid]
+            if not discovered:
+                del self._user_discovered[uid]
+
+        # discovery_count never goes down, so duplicates only ever join
+        if rec.discovery_count > 1:
+            self._user_duplicates.setdefault(uid, {})[rid] = rec
+
+        if rec.status == "processing":
+            self._processing[rid] = rec
+        elif old is not None and old.status == "processing":
+            del self._processing[rid]
+
+        # Stats only depend on status and processing_result
+        if (old is None
+                or old.status != rec.status
+                or old.processing_result is not rec.processing_result):
+            self._stats_cache.pop(uid, None)
+        return rec
+
+    def _upsert_discovered(
+        self,
+        uid: str,
+        message_id: str,
+        filter_results: Optional[Dict[str, Any]],
+        now: datetime,
+    ) -> EmailProcessingRecord:
+        """
+        Insert a discovered record or bump discovery_count on the existing one,
+        keyed on (user_id, message_id) with a single index probe.
+        Expects a validated message_id and a stringified user id.
+        """
+        key = (uid, message_id)
+        rec_id = self._index.get(key)
+
+        if rec_id is not None:
+            old = self._records[rec_id]
+            return self._put(
+                replace(old, discovery_count=old.discovery_count + 1, discovered_at=now),
+                old,
+            )
+
+        rec_id = str(uuid4())
+        self._index[key] = rec_id
+        return self._put(EmailProcessingRecord(
+            id=rec_id,
+            user_id=uid,
+            message_id=message_id,
+            status="discovered",
+            filter_results=filter_results or {},
+            discovery_count=1,
+            discovered_at=now,
+            processing_started_at=None,
+            processing_completed_at=None,
+            processing_attempts=0,
+            processing_result={},
+            last_retry_at=None,
+            max_retries=self._default_max_retries,
+            success=None,
+        ))
+
+    def _get_discovered(self, uid: str, message_id: str) -> EmailProcessingRecord:
+        """
+        Look up a user's record with a single index probe.
+        """
+        rec_id = self._index.get((uid, message_id))
+        if rec_id is None:
+            raise ValidationError("Email not discovered")
+        return self._records[rec_id]
+
+    def _drop_record(self, rec_id: str) -> EmailProcessingRecord:
+        """
+        Remove a record from the store and every index.
+        """
+        rec = self._records.pop(rec_id)
+        uid = rec.user_id
+        self._index.pop((uid, rec.message_id), None)
+        self._stats_cache.pop(uid, None)
+        self._processing.pop(rec_id, None)
+        for by_user in (self._user_records, self._user_discovered, self._user_duplicates):
+            user_recs = by_user.get(uid)
+            if user_recs is not None:
+                user_recs.pop(rec_id, None)
+                if not user_recs:
+                    del by_user[uid]
+        return rec
+
+    def _replay(
+        self,
+        uid: str,
+        idempotency_key: Optional[str],
+        now: datetime,
+    ) -> Optional[List[EmailProcessingRecord]]:
+        """
+        Return the stored response for a key seen within the window, else None.
+        """
+        if idempotency_key is None:
+            return None
+        seen = self._idempotency.get(uid, {}).get(idempotency_key)
+        if seen is None or now - seen[0] >= _IDEMPOTENCY_WINDOW:
+            return None
+        return list(seen[1])
+
+    def _remember(
+        self,
+        uid: str,
+        idempotency_key: Optional[str],
+        now: datetime,
+        results: List[EmailProcessingRecord],
+    ) -> None:
+        """
+        Store a discovery response under its idempotency key, if one was given.
+        """
+        if idempotency_key is not None:
+            self._idempotency.setdefault(uid, {})[idempotency_key] = (now, list(results))
+
     def mark_discovered(
         self,
         user_id: Any,
         message_id: str,
         filter_results: Optional[Dict[str, Any]] = None,
-    ) -> Dict[str, Any]:
+        idempotency_key: Optional[str] = None,
+    ) -> EmailProcessingRecord:
         """
         Mark an email as discovered. If already discovered, increment discovery_count.
-        """
-        if not message_id:
-            raise ValidationError("message_id cannot be empty")
-        if " " in message_id:
-            raise ValidationError("invalid message_id format")
 
-        uid = str(user_id)
-        key = (uid, message_id)
-        now = datetime.utcnow()
-
-        if key in self._index:
-            rec = self._records[self._index[key]]
-            rec["discovery_count"] += 1
-            rec["discovered_at"] = now
-        else:
-            rec_id = str(uuid4())
-            rec = {
-                "id": rec_id,
-                "user_id": uid,
-                "message_id": message_id,
-                "status": "discovered",
-                "filter_results": filter_results or {},
-                "discovery_count": 1,
-                "discovered_at": now,
-                "processing_started_at": None,
-                "processing_completed_at": None,
-                "processing_attempts": 0,
-                "processing_result": {},
-                "last_retry_at": None,
-                "max_retries": self._default_max_retries,
-                "success": None,
-            }
-            self._records[rec_id] = rec
-            self._index[key] = rec_id
-
-        return rec.copy()
+        A repeated idempotency_key within 24 hours returns the first response
+        without counting the discovery again.
+        """
+        return self._upsert_discovered_batch(
+            user_id, [(message_id, filter_results)], idempotency_key
+        )[0]
 
     def bulk_mark_discovered(
         self,
         user_id: Any,
         discoveries: List[Dict[str, Any]],
-    ) -> List[Dict[str, Any]]:
+        idempotency_key: Optional[str] = None,
+    ) -> List[EmailProcessingRecord]:
         """
         Bulk discovery of multiple emails.
         """
-        results: List[Dict[str, Any]] = []
-        for disc in discoveries:
-            msg_id = disc.get("message_id")
-            filter_res = disc.get("filter_results") or {}
-            res = self.mark_discovered(user_id, msg_id, filter_res)
-            results.append(res)
-        return results
+        rows = [(d.get("message_id"), d.get("filter_results")) for d in discoveries]
+        return self._upsert_discovered_batch(user_id, rows, idempotency_key)
 
     def mark_discovered_batch(
         self,
         user_id: Any,
         message_ids: List[str],
-    ) -> List[Dict[str, Any]]:
+        idempotency_key: Optional[str] = None,
+    ) -> List[EmailProcessingRecord]:
         """
         Mark multiple emails as discovered by message_id list.
         """
-        results: List[Dict[str, Any]] = []
-        for msg_id in message_ids:
-            res = self.mark_discovered(user_id, msg_id)
-            results.append(res)
+        return self._upsert_discovered_batch(
+            user_id, list(zip(message_ids, repeat(None))), idempotency_key
+        )
+
+    def _upsert_discovered_batch(
+        self,
+        user_id: Any,
+        rows: List[Tuple[str, Optional[Dict[str, Any]]]],
+        idempotency_key: Optional[str] = None,
+    ) -> List[EmailProcessingRecord]:
+        """
+        Upsert (message_id, filter_results) rows for one user as a single batch.
+
+        Every message_id is validated before anything is written, so a bad id
+        leaves the batch unapplied; the user id and timestamp are computed once.
+        Record ids are generated here, never by the store. Results come back
+        in input order; a replayed idempotency_key returns the stored results.
+        """
+        validate = self._validate_message_id
+        for message_id, _ in rows:
+            validate(message_id)
+
+        uid = str(user_id)
+        now = datetime.utcnow()
+        replayed = self._replay(uid, idempotency_key, now)
+        if replayed is not None:
+            return replayed
+
+        upsert = self._upsert_discovered
+        results = [
+            upsert(uid, message_id, filter_results, now)
+            for message_id, filter_results in rows
+        ]
+        self._remember(uid, idempotency_key, now, results)
         return results
 
-    def mark_processing_started(
+    def claim_for_processing(
         self,
         user_id: Any,
-        message_id: str,
-    ) -> Dict[str, Any]:
+        message_ids: List[str],
+    ) -> List[EmailProcessingRecord]:
         """
-        Mark a discovered email as processing.
+        Move several discovered emails to processing in one step.
+        All ids are checked before any is claimed, so a missing, repeated or
+        already-processing email leaves the whole batch untouched.
         """
         uid = str(user_id)
-        key = (uid, message_id)
-        if key not in self._index:
-            raise ValidationError("Email not discovered")
+        if len(set(message_ids)) != len(message_ids):
+            raise ValidationError("Duplicate message_id in claim batch")
+        recs = []
+        for message_id in message_ids:
+            rec = self._get_discovered(uid, message_id)
+            if rec.status == "processing":
+                raise ValidationError("Email already processing")
+            recs.append(rec)
 
-        rec = self._records[self._index[key]]
-        if rec["status"] == "processing":
-            raise ValidationError("Email already processing")
+        now = datetime.utcnow()
+        return [
+            self._put(replace(
+                rec,
+                status="processing",
+                processing_started_at=now,
+                processing_attempts=rec.processing_attempts + 1,
+            ), rec)
+            for rec in recs
+        ]
 
-        rec["status"] = "processing"
-        rec["processing_started_at"] = datetime.utcnow()
-        rec["processing_attempts"] += 1
-        return rec.copy()
+    def mark_processing_started(
+        self,
+        user_id: Any,
+        message_id: str,
+    ) -> EmailProcessingRecord:
+        """
+        Mark a discovered email as processing.
+        """
+        return self.claim_for_processing(user_id, [message_id])[0]
 
     def mark_processing_completed(
         self,
@@ -125,100 +328,136 @@ class EmailRepository:
         message_id: str,
         processing_result: Dict[str, Any],
         success: bool = True,
-    ) -> Dict[str, Any]:
+    ) -> EmailProcessingRecord:
         """
         Mark a processing email as completed (success or failure).
         """
-        uid = str(user_id)
-        key = (uid, message_id)
-        if key not in self._index:
-            raise ValidationError("Email not discovered")
-
-        rec = self._records[self._index[key]]
-        if rec["status"] != "processing":
+        rec = self._get_discovered(str(user_id), message_id)
+        if rec.status != "processing":
             raise ValidationError("Email not in processing state")
 
-        rec["status"] = "completed" if success else "failed"
-        rec["processing_completed_at"] = datetime.utcnow()
-        # Merge processing_result
-        rec["processing_result"].update(processing_result)
-        rec["success"] = success
-        return rec.copy()
+        return self._finish(
+            rec,
+            "completed" if success else "failed",
+            datetime.utcnow(),
+            processing_result,
+            success,
+        )
+
+    def _finish(
+        self,
+        rec: EmailProcessingRecord,
+        status: str,
+        now: datetime,
+        processing_result: Dict[str, Any],
+        success: bool,
+    ) -> EmailProcessingRecord:
+        """
+        Move a processing record to completed/failed, merging its result.
+        """
+        heapq.heappush(self._finished_heap, (now, rec.id))
+        merged = {**rec.processing_result, **processing_result}
+        return self._put(replace(
+            rec,
+            status=status,
+            processing_completed_at=now,
+            processing_result=merged,
+            success=success,
+            credits_used=merged.get("credits_used", 0),
+            processing_time=merged.get("processing_time", 0),
+        ), rec)
 
     def mark_for_retry(
         self,
         user_id: Any,
         message_id: str,
-    ) -> Dict[str, Any]:
+    ) -> EmailProcessingRecord:
         """
         After a failed processing, mark email to retry if below max retries.
         """
-        uid = str(user_id)
-        key = (uid, message_id)
-        if key not in self._index:
-            raise ValidationError("Email not discovered")
-
-        rec = self._records[self._index[key]]
-        attempts = rec.get("processing_attempts", 0)
-        max_retries = rec.get("max_retries", self._default_max_retries)
+        rec = self._get_discovered(str(user_id), message_id)
+        attempts = rec.processing_attempts
+        max_retries = rec.max_retries
         if attempts >= max_retries:
             raise ValidationError("Maximum retry attempts exceeded")
 
-        rec["status"] = "discovered"
-        rec["last_retry_at"] = datetime.utcnow()
-        # can_retry flag is dynamic
-        rec["can_retry"] = attempts < max_retries
-        return rec.copy()
+        return self._put(replace(
+            rec,
+            status="discovered",
+            last_retry_at=datetime.utcnow(),
+            # can_retry flag is dynamic
+            can_retry=attempts < max_retries,
+        ), rec)
 
     def get_processing_status(
         self,
         user_id: Any,
         message_id: str,
-    ) -> Optional[Dict[str, Any]]:
+    ) -> Optional[EmailProcessingRecord]:
         """
         Return the latest status for a given email or None.
         """
-        uid = str(user_id)
-        key = (uid, message_id)
-        if key not in self._index:
+        rec_id = self._index.get((str(user_id), message_id))
+        if rec_id is None:
             return None
-        return self._records[self._index[key]].copy()
+        return self._records[rec_id]
 
     def get_unprocessed_emails(
         self,
         user_id: Any,
         limit: Optional[int] = None,
-    ) -> List[Dict[str, Any]]:
+        after: Optional[Tuple[datetime, str]] = None,
+    ) -> List[EmailProcessingRecord]:
         """
         Get discovered emails that haven't been completed or failed.
-        Ordered by discovered_at ascending.
+        Ordered by discovered_at ascending, then message_id.
+
+        Paging is keyset-based: pass the (discovered_at, message_id) of the
+        last email of the previous page as `after`. Only the user's
+        discovered queue is read, and a limited page is picked with a
+        bounded heap instead of sorting the whole queue.
         """
         uid = str(user_id)
-        pending = [rec.copy() for rec in self._records.values()
-                   if rec["user_id"] == uid and rec["status"] == "discovered"]
-        pending.sort(key=lambda x: x["discovered_at"])  # oldest first
-        return pending[:limit] if limit is not None else pending
+        pending = self._user_discovered.get(uid, {}).values()
+        if after is not None:
+            pending = [rec for rec in pending
+                       if (rec.discovered_at, rec.message_id) > after]
+
+        def order(rec: EmailProcessingRecord) -> Tuple[datetime, str]:
+            return rec.discovered_at, rec.message_id
+
+        if limit is not None:
+            return heapq.nsmallest(limit, pending, key=order)
+        return sorted(pending, key=order)  # oldest first
 
     def get_processing_history(
         self,
         user_id: Any,
         limit: Optional[int] = None,
         status: Optional[str] = None,
-    ) -> List[Dict[str, Any]]:
+        before: Optional[Tuple[datetime, str]] = None,
+    ) -> List[EmailProcessingRecord]:
         """
         Get history of completed/failed processing for a user.
-        Ordered by processing_completed_at descending.
+        Ordered by processing_completed_at descending, then message_id.
+
+        Paging is keyset-based: pass the (processing_completed_at, message_id)
+        of the last email of the previous page as `before`.
         """
         uid = str(user_id)
-        hist = [rec.copy() for rec in self._records.values()
-                if rec["user_id"] == uid
-                and rec["status"] in ("completed", "failed")]
-        if status:
-            hist = [rec for rec in hist if rec["status"] == status]
-        hist.sort(key=lambda x: x["processing_completed_at"], reverse=True)
+        statuses = (status,) if status else ("completed", "failed")
+        hist = [rec for rec in self._user_records.get(uid, {}).values()
+                if rec.status in statuses]
+        if before is not None:
+            hist = [rec for rec in hist
+                    if (rec.processing_completed_at, rec.message_id) < before]
+
+        def order(rec: EmailProcessingRecord) -> Tuple[datetime, str]:
+            return rec.processing_completed_at, rec.message_id
+
         if limit is not None:
-            hist = hist[:limit]
-        return hist
+            return heapq.nlargest(limit, hist, key=order)
+        return sorted(hist, key=order, reverse=True)  # newest first
 
     def get_processing_stats(
         self,
@@ -228,21 +467,36 @@ class EmailRepository:
         Aggregate processing statistics for a user.
         """
         uid = str(user_id)
-        recs = [rec for rec in self._records.values() if rec["user_id"] == uid]
-        total_discovered = len(recs)
-        processed = [r for r in recs if r["status"] in ("completed", "failed")]
-        total_processed = len(processed)
-        successes = [r for r in processed if r["status"] == "completed"]
-        failures = [r for r in processed if r["status"] == "failed"]
-        total_successful = len(successes)
-        total_failed = len(failures)
+        cached = self._stats_cache.get(uid)
+        if cached is not None:
+            return cached.copy()
+        user_recs = self._user_records.get(uid)
+        if user_recs is None:
+            # Unknown user: nothing to aggregate and nothing worth caching
+            return {"user_id": uid, **_ZERO_STATS}
+
+        total_discovered = 0
+        total_successful = 0
+        total_failed = 0
+        total_credits_used = 0
+        total_processing_time = 0
+        # Single pass over the user's own records
+        for rec in user_recs.values():
+            total_discovered += 1
+            status = rec.status
+            if status == "completed":
+                total_successful += 1
+                total_credits_used += rec.credits_used
+                total_processing_time += rec.processing_time
+            elif status == "failed":
+                total_failed += 1
+
+        total_processed = total_successful + total_failed
         pending = total_discovered - total_processed
-        total_credits_used = sum(r["processing_result"].get("credits_used", 0) for r in successes)
-        avg_time = (sum(r["processing_result"].get("processing_time", 0) for r in successes) /
-                    total_successful) if total_successful > 0 else 0.0
+        avg_time = (total_processing_time / total_successful) if total_successful > 0 else 0.0
         success_rate = (total_successful / total_processed) if total_processed > 0 else 0.0
 
-        return {
+        stats = {
             "user_id": uid,
             "total_discovered": total_discovered,
             "total_processed": total_processed,
@@ -253,62 +507,93 @@ class EmailRepository:
             "total_credits_used": total_credits_used,
             "average_processing_time": avg_time,
         }
+        self._stats_cache[uid] = stats
+        return stats.copy()
 
     def cleanup_old_records(self, days: int) -> int:
         """
         Delete completed/failed records older than specified days.
         Returns number deleted.
         """
-        cutoff = datetime.utcnow() - timedelta(days=days)
-        to_delete = [rid for rid, rec in self._records.items()
-                     if rec.get("processing_completed_at") and rec["processing_completed_at"] < cutoff]
-        for rid in to_delete:
-            rec = self._records.pop(rid)
-            key = (rec["user_id"], rec["message_id"])
-            self._index.pop(key, None)
-        return len(to_delete)
+        now = datetime.utcnow()
+        cutoff = now - timedelta(days=days)
+        self._expire_idempotency_keys(now)
+        heap = self._finished_heap
+        deleted = 0
+        while heap and heap[0][0] < cutoff:
+            completed_at, rid = heapq.heappop(heap)
+            rec = self._records.get(rid)
+            # Skip entries for records since deleted, retried or re-finished
+            if (rec is None
+                    or rec.status not in ("completed", "failed")
+                    or rec.processing_completed_at != completed_at):
+                continue
+            self._drop_record(rid)
+            deleted += 1
+        return deleted
+
+    def _expire_idempotency_keys(self, now: datetime) -> None:
+        """
+        Forget idempotency keys whose replay window has passed.
+        """
+        for uid in list(self._idempotency):
+            keys = self._idempotency[uid]
+            for key in [k for k, (seen_at, _) in keys.items() if now - seen_at >= _IDEMPOTENCY_WINDOW]:
+                del keys[key]
+            if not keys:
+                del self._idempotency[uid]
 
-    def get_stale_processing_emails(self, minutes: int) -> List[Dict[str, Any]]:
+    def get_stale_processing_emails(self, minutes: int) -> List[EmailProcessingRecord]:
         """
         Get emails stuck in processing longer than given minutes.
         """
+        return self._stale_processing(minutes)
+
+    def _stale_processing(self, minutes: int) -> List[EmailProcessingRecord]:
+        """
+        In-flight records started more than given minutes ago.
+        """
         cutoff = datetime.utcnow() - timedelta(minutes=minutes)
-        stale = [rec.copy() for rec in self._records.values()
-                 if rec["status"] == "processing"
-                 and rec.get("processing_started_at")
-                 and rec["processing_started_at"] < cutoff]
-        return stale
+        return [rec for rec in self._processing.values()
+                if rec.processing_started_at
+                and rec.processing_started_at < cutoff]
+
+    def _fail_timeout(self, rec: EmailProcessingRecord, now: datetime) -> EmailProcessingRecord:
+        """
+        Move a processing record to failed with a timeout result.
+        """
+        return self._finish(
+            rec, "failed", now, {"error": "processing_timeout", "timeout": True}, False
+        )
 
     def mark_processing_timeout(
         self,
         user_id: Any,
         message_id: str,
-    ) -> Dict[str, Any]:
+    ) -> EmailProcessingRecord:
         """
         Mark a stale processing email as failed due to timeout.
         """
-        uid = str(user_id)
-        key = (uid, message_id)
-        if key not in self._index:
-            raise ValidationError("Email not discovered")
-        rec = self._records[self._index[key]]
-        if rec["status"] != "processing":
+        rec = self._get_discovered(str(user_id), message_id)
+        if rec.status != "processing":
             raise ValidationError("Email not in processing state")
 
-        rec["status"] = "failed"
-        rec["processing_completed_at"] = datetime.utcnow()
-        rec["processing_result"].update({"error": "processing_timeout", "timeout": True})
-        rec["success"] = False
-        return rec.copy()
+        return self._fail_timeout(rec, datetime.utcnow())
 
-    def get_duplicate_message_ids(self, user_id: Any) -> List[Dict[str, Any]]:
+    def timeout_stale(self, minutes: int) -> List[EmailProcessingRecord]:
+        """
+        Find emails stuck in processing longer than given minutes and mark
+        them failed due to timeout in the same call, so nothing can finish
+        between the lookup and the update. Returns the timed-out records.
+        """
+        now = datetime.utcnow()
+        return [self._fail_timeout(rec, now) for rec in self._stale_processing(minutes)]
+
+    def get_duplicate_message_ids(self, user_id: Any) -> List[EmailProcessingRecord]:
         """
         Return messages with discovery_count > 1 for a user.
         """
-        uid = str(user_id)
-        duplicates = [rec.copy() for rec in self._records.values()
-                      if rec["user_id"] == uid and rec.get("discovery_count", 0) > 1]
-        return duplicates
+        return list(self._user_duplicates.get(str(user_id), {}).values())
 
     def delete_user_email_data(self, user_id: Any) -> int:
         """
@@ -316,8 +601,27 @@ class EmailRepository:
         Returns count deleted.
         """
         uid = str(user_id)
-        to_delete = [rid for rid, rec in self._records.items() if rec["user_id"] == uid]
-        for rid in to_delete:
-            rec = self._records.pop(rid)
-            self._index.pop((rec["user_id"], rec["message_id"]), None)
-        return len(to_delete)
+        user_recs = self._user_records.pop(uid, {})
+        self._user_discovered.pop(uid, None)
+        self._user_duplicates.pop(uid, None)
+        self._stats_cache.pop(uid, None)
+        self._idempotency.pop(uid, None)
+        for rid, rec in user_recs.items():
+            del self._records[rid]
+            self._processing.pop(rid, None)
+            self._index.pop((uid, rec.message_id), None)
+        return len(user_recs)
+
+    # --- Testing Support Methods ---
+
+    def reset_records(self) -> None:
+        """Drop all in-memory records so one instance can be reused across tests"""
+        self._records.clear()
+        self._index.clear()
+        self._user_records.clear()
+        self._user_discovered.clear()
+        self._user_duplicates.clear()
+        self._stats_cache.clear()
+        self._finished_heap.clear()
+        self._processing.clear()
+        self._idempotency.clear()
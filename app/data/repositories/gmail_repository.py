@@ -1,24 +1,255 @@
+import heapq
+import os
+import struct
+import threading
+import time
 import uuid
+from bisect import bisect_right, insort
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from operator import itemgetter
+from typing import Optional, List, Dict, Any, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from app.core.exceptions import ValidationError, NotFoundError
 
+# Sealed token blob layout: key id (4 bytes) || nonce (12 bytes) || ciphertext+tag
+_KEY_ID = struct.Struct(">I")
+_NONCE_SIZE = 12
+_HEADER_SIZE = _KEY_ID.size + _NONCE_SIZE
+# Nonces are sliced from one os.urandom read of 340 nonces at a time
+_NONCE_POOL_SIZE = 340 * _NONCE_SIZE
+# Plaintext inside the seal: format tag (1 byte) || len(access) (4 bytes)
+# || access token || refresh token, both UTF-8
+_TOKENS_V1 = 1
+_TOKENS_HEADER = struct.Struct(">BI")
+
+# Recently opened token pairs kept in the clear, bounded in size and age
+_TOKEN_CACHE_SIZE = 256
+_TOKEN_CACHE_TTL_SECONDS = 30.0
+
+# How long a refresh idempotency key keeps answering retries with the current token
+_REFRESH_KEY_WINDOW = timedelta(hours=24)
+
+VALID_STATUSES = frozenset({"connected", "disconnected", "error", "pending"})
+# Google OAuth scopes are URLs; openid/userinfo scopes sit outside the gmail.* family
+_SCOPE_PREFIX = "https://"
+
+
+class _NonceSource:
+    """Per-thread buffer of random bytes handed out one nonce at a time."""
+    __slots__ = ("_buf", "_pos")
+
+    def __init__(self):
+        self._buf = b""
+        self._pos = 0
+
+    def next(self) -> bytes:
+        pos = self._pos
+        if pos + _NONCE_SIZE > len(self._buf):
+            self._buf = os.urandom(_NONCE_POOL_SIZE)
+            pos = 0
+        self._pos = pos + _NONCE_SIZE
+        return self._buf[pos:pos + _NONCE_SIZE]
+
+
+# One source per thread, so concurrent sealers never slice the same bytes
+_nonce_local = threading.local()
+
+
+def _reset_nonces() -> None:
+    # A forked child must not replay the parent's buffered nonces under a
+    # key it inherited (e.g. a repository built before a pre-fork server forks)
+    global _nonce_local
+    _nonce_local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_nonces)
+
+
+def _next_nonce() -> bytes:
+    source = getattr(_nonce_local, "source", None)
+    if source is None:
+        source = _nonce_local.source = _NonceSource()
+    return source.next()
+
 
 class GmailRepository:
     """
     In-memory repository for Gmail connections and sync metadata, per TDD tests.
     """
-    VALID_STATUSES = {"connected", "disconnected", "error", "pending"}
+    VALID_STATUSES = VALID_STATUSES
 
-    def __init__(self):
+    def __init__(self, encryption_key: Optional[bytes] = None):
         # user_id (str) -> connection dict
         self._connections: Dict[str, Dict[str, Any]] = {}
+        # AES-256-GCM key generations by id; each sealed blob names its key,
+        # so rotation re-seals one user at a time while older keys still open
+        # the rest. A generation is dropped once no stored blob uses it.
+        # The current generation's cipher and packed header are kept on hand
+        # so sealing only allocates the nonce and ciphertext.
+        self._key_id = 0
+        self._cipher = AESGCM(encryption_key or AESGCM.generate_key(bit_length=256))
+        self._key_header = _KEY_ID.pack(0)
+        self._ciphers: Dict[int, AESGCM] = {0: self._cipher}
+        self._key_refs: Dict[int, int] = {0: 0}
+        # LRU of user_id -> (access_token, refresh_token, expires_monotonic) so
+        # back-to-back reads skip the decrypt; written through on every re-seal
+        self._token_cache: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        # Guards only the compare-and-swap step of a token refresh
+        self._refresh_lock = threading.Lock()
+        # Secondary indexes: status -> user_ids (dict as an ordered set) and
+        # (token_expires_at, user_id) kept sorted, so status listings and the
+        # refresh sweep touch only matching connections instead of all of them
+        self._by_status: Dict[str, Dict[str, None]] = {}
+        self._expiry_index: List[Tuple[datetime, str]] = []
         # user_id -> list of sync records
         self._sync_history: Dict[str, List[Dict[str, Any]]] = {}
+        # sync_id -> the same record object held in _sync_history
+        self._sync_by_id: Dict[str, Dict[str, Any]] = {}
+        # user_id -> sync-history rollup for get_connection_stats; dropped on
+        # any write to that user's history and rebuilt on the next read
+        self._sync_stats: Dict[str, Dict[str, Any]] = {}
         # user_id -> list of activity logs
         self._activities: Dict[str, List[Dict[str, Any]]] = {}
 
+    def _seal_tokens(self, key: str, access_token: str, refresh_token: str) -> bytes:
+        """Encrypt a token pair under the current key, bound to the user id."""
+        nonce = _next_nonce()
+        access = access_token.encode()
+        plaintext = _TOKENS_HEADER.pack(_TOKENS_V1, len(access)) + access + refresh_token.encode()
+        return self._key_header + nonce + self._cipher.encrypt(nonce, plaintext, key.encode())
+
+    def _open_tokens(self, key: str, blob: bytes) -> Tuple[str, str]:
+        """Decrypt a sealed token pair; tampered or misfiled blobs are rejected."""
+        (key_id,) = _KEY_ID.unpack_from(blob)
+        cipher = self._ciphers.get(key_id)
+        try:
+            if cipher is None:
+                raise InvalidTag()
+            plaintext = cipher.decrypt(blob[_KEY_ID.size:_HEADER_SIZE], blob[_HEADER_SIZE:], key.encode())
+        except InvalidTag:
+            raise ValidationError("stored tokens failed integrity check")
+        tag, access_len = _TOKENS_HEADER.unpack_from(plaintext)
+        if tag != _TOKENS_V1:
+            raise ValidationError(f"unsupported stored token format: {tag}")
+        split = _TOKENS_HEADER.size + access_len
+        return plaintext[_TOKENS_HEADER.size:split].decode(), plaintext[split:].decode()
+
+    def _tokens_for(self, key: str, conn: Dict[str, Any]) -> Tuple[str, str]:
+        """A connection's token pair, from the LRU cache when still fresh."""
+        cached = self._token_cache.get(key)
+        now = time.monotonic()
+        if cached is not None and cached[2] > now:
+            self._token_cache.move_to_end(key)
+            return cached[0], cached[1]
+        access_token, refresh_token = self._open_tokens(key, conn["sealed_tokens"])
+        self._cache_tokens(key, access_token, refresh_token, now)
+        return access_token, refresh_token
+
+    def _cache_tokens(self, key: str, access_token: str, refresh_token: str, now: float) -> None:
+        """Insert or refresh an LRU entry, evicting the least recently used."""
+        cache = self._token_cache
+        cache[key] = (access_token, refresh_token, now + _TOKEN_CACHE_TTL_SECONDS)
+        cache.move_to_end(key)
+        if len(cache) > _TOKEN_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def _set_tokens(self, conn: Dict[str, Any], access_token: str, refresh_token: str) -> None:
+        """Seal tokens into a connection, releasing the key of the blob it replaces."""
+        old = conn.get("sealed_tokens")
+        conn["sealed_tokens"] = self._seal_tokens(conn["user_id"], access_token, refresh_token)
+        self._key_refs[self._key_id] += 1
+        if old is not None:
+            self._release_key(old)
+        self._cache_tokens(conn["user_id"], access_token, refresh_token, time.monotonic())
+
+    def _set_status(self, conn: Dict[str, Any], status: str) -> None:
+        """Change a connection's status, moving it between status buckets."""
+        key = conn["user_id"]
+        old = conn.get("connection_status")
+        if old is not None:
+            self._by_status.get(old, {}).pop(key, None)
+        conn["connection_status"] = status
+        self._by_status.setdefault(status, {})[key] = None
+
+    def _set_expiry(self, conn: Dict[str, Any], expires_at: Optional[datetime]) -> None:
+        """Change a connection's token expiry, keeping the expiry index sorted."""
+        key = conn["user_id"]
+        old = conn.get("token_expires_at")
+        if old is not None:
+            index = self._expiry_index
+            pos = bisect_right(index, (old, key)) - 1
+            if pos >= 0 and index[pos] == (old, key):
+                del index[pos]
+        conn["token_expires_at"] = expires_at
+        if expires_at is not None:
+            insort(self._expiry_index, (expires_at, key))
+
+    def _unindex(self, conn: Dict[str, Any]) -> None:
+        """Remove a connection from the secondary indexes."""
+        self._set_expiry(conn, None)
+        self._by_status.get(conn.get("connection_status"), {}).pop(conn["user_id"], None)
+
+    def _drop_sync_history(self, key: str) -> None:
+        """Forget a user's sync records along with their sync_id entries."""
+        sync_by_id = self._sync_by_id
+        for rec in self._sync_history.pop(key, ()):
+            sync_by_id.pop(rec["sync_id"], None)
+        self._sync_stats.pop(key, None)
+
+    def _sync_rollup(self, key: str) -> Dict[str, Any]:
+        """Sync-history aggregates for a user, served from the rollup when fresh."""
+        rollup = self._sync_stats.get(key)
+        if rollup is not None:
+            return rollup
+        history = self._sync_history.get(key, [])
+        # One pass over the history accumulates every aggregate
+        total_processed = 0
+        duration_total = 0
+        duration_count = 0
+        completed_at = []
+        for rec in history:
+            total_processed += rec.get("messages_processed", 0)
+            duration = rec.get("duration")
+            if duration is not None:
+                duration_total += duration
+                duration_count += 1
+            if rec.get("status") == "completed":
+                completed_at.append(rec.get("completed_at"))
+        successful = len(completed_at)
+        rollup = {
+            "total_emails_processed": total_processed,
+            "successful_syncs": successful,
+            "failed_syncs": len(history) - successful,
+            "average_sync_time": (duration_total / duration_count) if duration_count else 0.0,
+            "last_successful_sync": max(completed_at) if completed_at else None,
+        }
+        self._sync_stats[key] = rollup
+        return rollup
+
+    def _remove_user(self, key: str) -> bool:
+        """Delete a user's connection and everything hanging off it (key
+        reference, indexes, token cache, sync history, activity log)."""
+        conn = self._connections.pop(key, None)
+        if conn is not None:
+            self._release_key(conn["sealed_tokens"])
+            self._unindex(conn)
+        self._token_cache.pop(key, None)
+        self._drop_sync_history(key)
+        self._activities.pop(key, None)
+        return conn is not None
+
+    def _release_key(self, blob: bytes) -> None:
+        """Drop one reference to a blob's key; retire old keys nobody uses."""
+        (key_id,) = _KEY_ID.unpack_from(blob)
+        self._key_refs[key_id] -= 1
+        if self._key_refs[key_id] == 0 and key_id != self._key_id:
+            del self._key_refs[key_id]
+            del self._ciphers[key_id]
+
     def store_oauth_tokens(
         self,
         user_id: uuid.UUID,
@@ -40,22 +271,20 @@ class GmailRepository:
         scopes = scope_str.split() if isinstance(scope_str, str) else []
 
         now = datetime.utcnow()
-        expires_at = now + timedelta(seconds=tokens["expires_in"])
 
-        # Build base connection record
+        # Build base connection record; tokens are only kept sealed
         conn = {
             "user_id": str(user_id),
-            "access_token": tokens["access_token"],
-            "refresh_token": tokens["refresh_token"],
             "token_type": tokens.get("token_type"),
             "expires_in": tokens["expires_in"],
-            "token_expires_at": expires_at,
             "scopes": scopes,
-            "connection_status": "connected",
             "email_address": None,
             "profile_info": {},
             "metadata": {},
             "sync_metadata": {},
+            "token_version": 0,
+            # refresh idempotency_key -> when it first refreshed this connection
+            "refresh_keys": {},
             "created_at": now,
             "updated_at": now,
         }
@@ -64,20 +293,30 @@ class GmailRepository:
             conn["email_address"] = user_info.get("email")
             conn["profile_info"] = {k: v for k, v in user_info.items() if k != "email"}
 
+        self._set_tokens(conn, tokens["access_token"], tokens["refresh_token"])
+        previous = self._connections.get(str(user_id))
+        if previous is not None:
+            self._release_key(previous["sealed_tokens"])
+            self._unindex(previous)
+        self._set_status(conn, "connected")
+        self._set_expiry(conn, now + timedelta(seconds=tokens["expires_in"]))
         self._connections[str(user_id)] = conn
         # Initialize histories
+        self._drop_sync_history(str(user_id))
         self._sync_history[str(user_id)] = []
         self._activities[str(user_id)] = []
         return True
 
     def get_oauth_tokens(self, user_id: uuid.UUID) -> Optional[Dict[str, Any]]:
-        conn = self._connections.get(str(user_id))
+        key = str(user_id)
+        conn = self._connections.get(key)
         if not conn:
             return None
+        access_token, refresh_token = self._tokens_for(key, conn)
         # Return primary token data
         return {
-            "access_token": conn["access_token"],
-            "refresh_token": conn["refresh_token"],
+            "access_token": access_token,
+            "refresh_token": refresh_token,
             "expires_in": conn["expires_in"],
             "token_type": conn.get("token_type"),
             "scope": " ".join(conn.get("scopes", [])),
@@ -87,6 +326,10 @@ class GmailRepository:
         conn = self._connections.get(str(user_id))
         if not conn:
             return None
+        return self._connection_info(conn)
+
+    def _connection_info(self, conn: Dict[str, Any]) -> Dict[str, Any]:
+        """Public view of a stored connection (no token material)."""
         info = {
             "user_id": conn["user_id"],
             "email_address": conn.get("email_address"),
@@ -116,29 +359,61 @@ class GmailRepository:
         conn = self._connections.get(str(user_id))
         if not conn:
             return False
-        conn["connection_status"] = status
+        self._set_status(conn, status)
         conn["updated_at"] = datetime.utcnow()
         if error_info is not None:
             conn["error_info"] = error_info
         return True
 
-    def refresh_access_token(self, user_id: uuid.UUID) -> Dict[str, Any]:
+    def refresh_access_token(
+        self,
+        user_id: uuid.UUID,
+        idempotency_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Mint a new access token. A retry carrying an idempotency_key that
+        already refreshed this connection (within 24 hours) gets the current
+        token back instead of triggering another refresh.
+        """
         key = str(user_id)
         conn = self._connections.get(key)
         if not conn:
             raise NotFoundError("Connection not found")
+        if idempotency_key is not None:
+            seen_at = conn["refresh_keys"].get(idempotency_key)
+            if seen_at is not None and datetime.utcnow() - seen_at < _REFRESH_KEY_WINDOW:
+                access_token, _ = self._tokens_for(key, conn)
+                return {"access_token": access_token, "expires_in": conn["expires_in"]}
+        version = conn["token_version"]
+        _, refresh_token = self._tokens_for(key, conn)
         # Simulate invalid refresh token
-        if conn.get("refresh_token") == "invalid_refresh_token":
-            conn["connection_status"] = "error"
+        if refresh_token == "invalid_refresh_token":
+            self._set_status(conn, "error")
             raise ValidationError("invalid refresh token")
         # Generate new token
         new_token = uuid.uuid4().hex
-        conn["access_token"] = new_token
-        # Reset expiry
         expires = conn.get("expires_in", 3600)
-        conn["expires_in"] = expires
-        conn["token_expires_at"] = datetime.utcnow() + timedelta(seconds=expires)
-        conn["updated_at"] = datetime.utcnow()
+        with self._refresh_lock:
+            current = self._connections.get(key)
+            if current is None:
+                raise NotFoundError("Connection not found")
+            if current is not conn or current["token_version"] != version:
+                # Another refresh (or reconnect) won since we read the tokens;
+                # hand back the winner's token instead of overwriting it
+                access_token, _ = self._tokens_for(key, current)
+                return {"access_token": access_token, "expires_in": current["expires_in"]}
+            self._set_tokens(conn, new_token, refresh_token)
+            conn["token_version"] = version + 1
+            # Reset expiry
+            conn["expires_in"] = expires
+            now = datetime.utcnow()
+            self._set_expiry(conn, now + timedelta(seconds=expires))
+            conn["updated_at"] = now
+            if idempotency_key is not None:
+                refresh_keys = conn["refresh_keys"]
+                for stale in [k for k, seen_at in refresh_keys.items() if now - seen_at >= _REFRESH_KEY_WINDOW]:
+                    del refresh_keys[stale]
+                refresh_keys[idempotency_key] = now
         return {"access_token": new_token, "expires_in": expires}
 
     def update_sync_metadata(self, user_id: uuid.UUID, sync_metadata: Dict[str, Any]) -> bool:
@@ -150,28 +425,26 @@ class GmailRepository:
         return True
 
     def get_connections_by_status(self, status: str) -> List[Dict[str, Any]]:
-        return [self.get_connection_info(uuid.UUID(uid))
-                for uid, conn in self._connections.items()
-                if conn.get("connection_status") == status]
+        connections = self._connections
+        return [self._connection_info(connections[uid])
+                for uid in self._by_status.get(status, ())]
 
     def get_connections_needing_refresh(self, threshold_minutes: int = 5) -> List[Dict[str, Any]]:
-        threshold_seconds = threshold_minutes * 60
-        results = []
-        now = datetime.utcnow()
-        for uid, conn in self._connections.items():
-            if conn.get("connection_status") != "connected":
-                continue
-            expires_at = conn.get("token_expires_at")
-            if expires_at and (expires_at - now).total_seconds() <= threshold_seconds:
-                results.append(self.get_connection_info(uuid.UUID(uid)))
-        return results
+        # Range scan of the expiry index up to the cutoff, soonest first
+        cutoff = datetime.utcnow() + timedelta(minutes=threshold_minutes)
+        index = self._expiry_index
+        end = bisect_right(index, cutoff, key=itemgetter(0))
+        connected = self._by_status.get("connected", {})
+        connections = self._connections
+        return [self._connection_info(connections[uid])
+                for _, uid in index[:end] if uid in connected]
 
     def update_scopes(self, user_id: uuid.UUID, scopes: List[str]) -> bool:
         if not scopes:
             raise ValidationError("scopes cannot be empty")
-        for s in scopes:
-            if not s.startswith("https://"):
-                raise ValidationError("invalid scope format")
+        bad = [s for s in scopes if not s.startswith(_SCOPE_PREFIX)]
+        if bad:
+            raise ValidationError(f"invalid scope format: {bad}")
         conn = self._connections.get(str(user_id))
         if not conn:
             return False
@@ -180,37 +453,17 @@ class GmailRepository:
         return True
 
     def delete_connection(self, user_id: uuid.UUID) -> bool:
-        key = str(user_id)
-        if key not in self._connections:
-            return False
-        self._connections.pop(key)
-        self._sync_history.pop(key, None)
-        self._activities.pop(key, None)
-        return True
+        return self._remove_user(str(user_id))
 
     def get_connection_stats(self, user_id: uuid.UUID) -> Dict[str, Any]:
         key = str(user_id)
         conn = self._connections.get(key)
         if not conn:
             raise NotFoundError("Connection not found")
-        history = self._sync_history.get(key, [])
-        total_processed = sum(rec.get("messages_processed", 0) for rec in history)
-        successful = sum(1 for rec in history if rec.get("status") == "completed")
-        failed = sum(1 for rec in history if rec.get("status") != "completed")
-        durations = [rec.get("duration", 0) for rec in history if rec.get("duration") is not None]
-        avg_time = (sum(durations) / len(durations)) if durations else 0.0
-        last_success = None
-        completed_recs = [rec for rec in history if rec.get("status") == "completed"]
-        if completed_recs:
-            last_success = max(rec.get("completed_at") for rec in completed_recs)
         uptime = (datetime.utcnow() - conn.get("created_at")).total_seconds()
         return {
             "user_id": key,
-            "total_emails_processed": total_processed,
-            "successful_syncs": successful,
-            "failed_syncs": failed,
-            "average_sync_time": avg_time,
-            "last_successful_sync": last_success,
+            **self._sync_rollup(key),
             "connection_uptime": uptime,
             "scopes_count": len(conn.get("scopes", [])),
         }
@@ -225,17 +478,38 @@ class GmailRepository:
         # Ensure typed fields
         rec["started_at"] = rec.get("started_at")
         self._sync_history.setdefault(key, []).append(rec)
+        self._sync_by_id[sync_id] = rec
+        self._sync_stats.pop(key, None)
         return rec.copy()
 
+    def record_sync_attempts_bulk(self, user_id: uuid.UUID, syncs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Record several sync attempts for one user in one call; each entry may
+        already carry its completion fields."""
+        key = str(user_id)
+        if key not in self._connections:
+            raise NotFoundError("Connection not found")
+        history = self._sync_history.setdefault(key, [])
+        sync_by_id = self._sync_by_id
+        recorded = []
+        for sync_data in syncs:
+            rec = sync_data.copy()
+            rec["user_id"] = key
+            rec["sync_id"] = uuid.uuid4().hex
+            rec["started_at"] = rec.get("started_at")
+            history.append(rec)
+            sync_by_id[rec["sync_id"]] = rec
+            recorded.append(rec.copy())
+        self._sync_stats.pop(key, None)
+        return recorded
+
     def update_sync_completion(self, sync_id: str, completion_data: Dict[str, Any]) -> bool:
-        # Find record
-        for key, recs in self._sync_history.items():
-            for rec in recs:
-                if rec.get("sync_id") == sync_id:
-                    # Update fields
-                    rec.update(completion_data)
-                    return True
-        return False
+        rec = self._sync_by_id.get(sync_id)
+        if rec is None:
+            return False
+        # Completion fields (timestamps included) are stored as given
+        rec.update(completion_data)
+        self._sync_stats.pop(rec["user_id"], None)
+        return True
 
     def get_sync_history(
         self,
@@ -244,24 +518,38 @@ class GmailRepository:
         status: Optional[str] = None,
     ) -> List[Dict[str, Any]]:
         key = str(user_id)
-        recs = list(self._sync_history.get(key, []))
+        recs = self._sync_history.get(key, [])
         # Filter by status
         if status:
             recs = [rec for rec in recs if rec.get("status") == status]
-        # Sort by started_at descending (ISO strings or datetimes)
+        # Newest first by started_at (ISO strings or datetimes); with a limit
+        # only the top `limit` are selected rather than sorting the whole history
+        started_at = itemgetter("started_at")
         try:
-            recs.sort(key=lambda r: r.get("started_at"), reverse=True)
-        except Exception:
-            pass
-        if limit is not None:
-            recs = recs[:limit]
+            if limit is not None:
+                recs = heapq.nlargest(limit, recs, key=started_at)
+            else:
+                recs = sorted(recs, key=started_at, reverse=True)
+        except TypeError:
+            # Mixed/missing timestamps: fall back to insertion order
+            if limit is not None:
+                recs = recs[:limit]
         return [rec.copy() for rec in recs]
 
     def batch_update_connection_status(self, updates: List[Dict[str, Any]]) -> int:
+        # Normalize and validate the whole batch before touching any row, so an
+        # invalid status leaves every connection unchanged
+        rows = [(str(uuid.UUID(upd.get("user_id"))), upd.get("status")) for upd in updates]
+        if any(status not in self.VALID_STATUSES for _, status in rows):
+            raise ValidationError("invalid connection status")
+        now = datetime.utcnow()
+        connections = self._connections
         count = 0
-        for upd in updates:
-            uid = uuid.UUID(upd.get("user_id"))
-            if self.update_connection_status(uid, upd.get("status")):
+        for key, status in rows:
+            conn = connections.get(key)
+            if conn is not None:
+                self._set_status(conn, status)
+                conn["updated_at"] = now
                 count += 1
         return count
 
@@ -270,7 +558,23 @@ class GmailRepository:
         conn = self._connections.get(key)
         if not conn:
             return None
+        return self._health(key, conn, datetime.utcnow())
+
+    def check_connection_health_bulk(self, user_ids: List[uuid.UUID]) -> List[Dict[str, Any]]:
+        """Health reports for a monitoring sweep, all measured against one clock
+        reading; users without a connection are skipped."""
         now = datetime.utcnow()
+        connections = self._connections
+        reports = []
+        for user_id in user_ids:
+            key = str(user_id)
+            conn = connections.get(key)
+            if conn is not None:
+                reports.append(self._health(key, conn, now))
+        return reports
+
+    def _health(self, key: str, conn: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+        """Build one connection's health report as of ``now``."""
         expires_at = conn.get("token_expires_at")
         expires_in = (expires_at - now).total_seconds() if expires_at else 0
         health = {
@@ -287,10 +591,23 @@ class GmailRepository:
 
     def rotate_encryption_key(self, user_id: uuid.UUID) -> bool:
         key = str(user_id)
-        if key not in self._connections:
+        conn = self._connections.get(key)
+        if not conn:
             return False
-        # Simulate re-encrypt by bumping updated_at
-        self._connections[key]["updated_at"] = datetime.utcnow()
+        access_token, refresh_token = self._tokens_for(key, conn)
+        # New key generation becomes current; other users' blobs keep opening
+        # with their own key until they are next written
+        previous_id = self._key_id
+        self._key_id += 1
+        self._cipher = AESGCM(AESGCM.generate_key(bit_length=256))
+        self._key_header = _KEY_ID.pack(self._key_id)
+        self._ciphers[self._key_id] = self._cipher
+        self._key_refs[self._key_id] = 0
+        self._set_tokens(conn, access_token, refresh_token)
+        if self._key_refs.get(previous_id) == 0:
+            del self._key_refs[previous_id]
+            del self._ciphers[previous_id]
+        conn["updated_at"] = datetime.utcnow()
         return True
 
     def update_connection_metadata(self, user_id: uuid.UUID, metadata: Dict[str, Any]) -> bool:
@@ -308,15 +625,34 @@ class GmailRepository:
         self._activities.setdefault(key, []).append(activity.copy())
         return True
 
+    def log_connection_activity_bulk(self, user_id: uuid.UUID, activities: List[Dict[str, Any]]) -> int:
+        """Append several activity entries in one call; returns how many were
+        logged (0 when the user has no connection)."""
+        key = str(user_id)
+        if key not in self._connections:
+            return 0
+        self._activities.setdefault(key, []).extend(activity.copy() for activity in activities)
+        return len(activities)
+
     def get_connection_activity_log(self, user_id: uuid.UUID, limit: int = 10) -> List[Dict[str, Any]]:
         key = str(user_id)
-        logs = list(self._activities.get(key, []))
-        return logs[-limit:]
+        # Slice the tail straight off the user's log; no full-log copy first
+        return self._activities.get(key, [])[-limit:]
 
     def cleanup_user_connections(self, user_id: uuid.UUID) -> bool:
-        key = str(user_id)
-        existed = key in self._connections
-        self._connections.pop(key, None)
-        self._sync_history.pop(key, None)
-        self._activities.pop(key, None)
-        return existed
+        return self._remove_user(str(user_id))
+
+    # --- Testing Support Methods ---
+
+    def reset_connections(self) -> None:
+        """Drop all in-memory state so one instance can be reused across tests"""
+        self._connections.clear()
+        self._ciphers = {self._key_id: self._cipher}
+        self._key_refs = {self._key_id: 0}
+        self._token_cache.clear()
+        self._by_status.clear()
+        self._expiry_index.clear()
+        self._sync_history.clear()
+        self._sync_by_id.clear()
+        self._sync_stats.clear()
+        self._activities.clear()
@@ -1,9 +1,14 @@
+import heapq
+import threading
 from datetime import datetime, timedelta
 from uuid import uuid4
 from typing import Any, Dict, List, Optional
 
 from app.core.exceptions import ValidationError, NotFoundError
 
+# Queue order: high before normal before low, then earliest scheduled_for
+_PRIORITY_RANK = {"high": 0, "normal": 1, "low": 2}
+
 
 class JobRepository:
     """
@@ -17,6 +22,11 @@ class JobRepository:
     def __init__(self):
         # Internal storage for job records
         self._jobs: Dict[str, Dict[str, Any]] = {}
+        # Ids of jobs in "pending" status (dict as an ordered set), so the
+        # queue read skips running and finished jobs entirely
+        self._pending: Dict[str, None] = {}
+        # Makes claim_job's status check and transition one atomic step
+        self._claim_lock = threading.Lock()
 
     def create_job(self, job_data: Dict[str, Any]) -> Dict[str, Any]:
         # Required fields
@@ -80,34 +90,45 @@ class JobRepository:
             "updated_at": now,
         }
         self._jobs[job_id] = record
+        if status == "pending":
+            self._pending[job_id] = None
         return record.copy()
 
     def get_pending_jobs(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         now = datetime.utcnow()
         # Filter ready pending jobs
-        pending = []
-        for r in self._jobs.values():
-            if r["status"] == "pending":
-                scheduled_time = datetime.fromisoformat(r["scheduled_for"])
-                if scheduled_time <= now:
-                    pending.append(r.copy())
-        # Sort by priority (high, normal, low) and scheduled time
-        priority_order = {"high": 0, "normal": 1, "low": 2}
-        pending.sort(key=lambda r: (priority_order.get(r["priority"], 1), r["scheduled_for"]))
-        return pending[:limit] if limit is not None else pending
+        jobs = self._jobs
+        ready = []
+        for job_id in self._pending:
+            r = jobs[job_id]
+            if datetime.fromisoformat(r["scheduled_for"]) <= now:
+                ready.append(r)
+        # Order by priority (high, normal, low) and scheduled time; with a limit
+        # only the first `limit` are selected, and only those are copied
+        order = lambda r: (_PRIORITY_RANK.get(r["priority"], 1), r["scheduled_for"])
+        if limit is not None:
+            ready = heapq.nsmallest(limit, ready, key=order)
+        else:
+            ready.sort(key=order)
+        return [r.copy() for r in ready]
 
     def claim_job(self, job_id: str, worker_id: str) -> Dict[str, Any]:
-        rec = self._jobs.get(job_id)
-        if not rec:
-            raise NotFoundError("job not found")
-        if rec["status"] != "pending":
-            raise ValidationError("job already claimed")
-        rec["status"] = "running"
-        rec["worker_id"] = worker_id
-        rec["started_at"] = datetime.utcnow().isoformat()
-        rec["attempts"] += 1
-        rec["updated_at"] = datetime.utcnow().isoformat()
-        return rec.copy()
+        now = datetime.utcnow().isoformat()
+        # Check-and-set under one lock so exactly one of several concurrent
+        # workers moves a pending job to running
+        with self._claim_lock:
+            rec = self._jobs.get(job_id)
+            if not rec:
+                raise NotFoundError("job not found")
+            if rec["status"] != "pending":
+                raise ValidationError("job already claimed")
+            rec["status"] = "running"
+            self._pending.pop(job_id, None)
+            rec["worker_id"] = worker_id
+            rec["started_at"] = now
+            rec["attempts"] += 1
+            rec["updated_at"] = now
+            return rec.copy()
 
     def mark_job_completed(self, job_id: str, result: Dict[str, Any]) -> Dict[str, Any]:
         rec = self._jobs.get(job_id)
@@ -143,6 +164,7 @@ class JobRepository:
             raise ValidationError("maximum retry attempts exceeded")
         # Reset for retry
         rec["status"] = "pending"
+        self._pending[job_id] = None
         rec["scheduled_for"] = (datetime.utcnow() + delay).isoformat()
         rec["worker_id"] = None
         rec["started_at"] = None
@@ -269,6 +291,7 @@ class JobRepository:
                 to_delete.append(jid)
         for jid in to_delete:
             self._jobs.pop(jid, None)
+            self._pending.pop(jid, None)
         return len(to_delete)
 
     def delete_user_jobs(self, user_id: Any) -> int:
@@ -276,4 +299,5 @@ class JobRepository:
         to_delete = [jid for jid, r in self._jobs.items() if r["user_id"] == uid]
         for jid in to_delete:
             self._jobs.pop(jid, None)
+            self._pending.pop(jid, None)
         return len(to_delete)
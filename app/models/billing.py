@@ -5,13 +5,16 @@ Provides strongly-typed models for billing operations.
 """
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 from uuid import UUID
-from app.core.billing_config import CreditPackage
 
-@dataclass
+if TYPE_CHECKING:
+    # billing_config builds the settings singleton on import; only needed for typing
+    from app.core.billing_config import CreditPackage
+
+@dataclass(slots=True)
 class TransactionRecord:
-    """Represents a billing transaction record from the database"""
+    """Represents a billing transaction record from the database (slotted: one per row read)"""
     id: UUID
     user_id: UUID
     transaction_type: str
@@ -89,7 +92,7 @@ class CheckoutSession:
     """Represents a Stripe checkout session"""
     session_id: str
     checkout_url: str
-    package: CreditPackage
+    package: "CreditPackage"
     expires_at: datetime
     customer_id: Optional[str] = None
     metadata: Optional[Dict[str, Any]] = None
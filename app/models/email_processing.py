@@ -0,0 +1,55 @@
+# app/models/email_processing.py
+"""
+Email processing domain model: one record per (user, Gmail message) tracking
+its way through discovery, processing, retries and timeouts.
+"""
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+@dataclass(slots=True, frozen=True)
+class EmailProcessingRecord:
+    """Immutable processing record (slotted: one per tracked email).
+
+    Supports read-only mapping access (record["status"], record.get(...),
+    "status" in record) so callers written against plain dict rows keep working.
+    """
+    id: str
+    user_id: str
+    message_id: str
+    status: str
+    filter_results: Dict[str, Any]
+    discovery_count: int
+    discovered_at: datetime
+    processing_started_at: Optional[datetime]
+    processing_completed_at: Optional[datetime]
+    processing_attempts: int
+    processing_result: Dict[str, Any]
+    last_retry_at: Optional[datetime]
+    max_retries: int
+    success: Optional[bool]
+    can_retry: Optional[bool] = None
+    # Copied out of processing_result when processing finishes, so stats
+    # aggregate plain fields instead of probing the result blob per row
+    credits_used: int = 0
+    processing_time: float = 0.0
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in _FIELD_NAMES:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in _FIELD_NAMES
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Dict-style lookup with a default for unknown keys"""
+        if key not in _FIELD_NAMES:
+            return default
+        return getattr(self, key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert to dictionary for serialization"""
+        return asdict(self)
+
+_FIELD_NAMES = frozenset(f.name for f in fields(EmailProcessingRecord))
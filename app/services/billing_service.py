@@ -202,8 +202,9 @@ class BillingService:
         profile = self.user_repo.get_user_profile(str(user_id))
         if not profile:
             raise NotFoundError("User not found.")
-        txn = await self.billing_repo.add_credits(
+        txn = await self.billing_repo.create_transaction(
             user_id=user_id,
+            transaction_type="bonus",
             credit_amount=credits,
             credit_balance_after=profile["credits_remaining"] + credits,
             description=note,
@@ -221,9 +222,10 @@ class BillingService:
             raise NotFoundError("User not found.")
         if profile.get("credits_remaining", 0) < credits:
             raise ValidationError("Insufficient credits for manual deduction.")
-        txn = await self.billing_repo.deduct_credits(
+        txn = await self.billing_repo.create_transaction(
             user_id=user_id,
-            credit_amount=credits,
+            transaction_type="adjustment",
+            credit_amount=-credits,
             credit_balance_after=profile["credits_remaining"] - credits,
             description=reason,
             metadata={"source": "admin", "reason": reason}
@@ -1,34 +1,128 @@
+import itertools
 import pytest
 from uuid import uuid4
 from datetime import datetime
-from unittest.mock import AsyncMock, MagicMock
-
+from unittest.mock import AsyncMock
 
 from app.data.repositories.billing_repository import BillingRepository
-from app.core.exceptions import (
+from app.api.exceptions import (
     DuplicateTransactionError,
     InvalidTransactionTypeError,
     TransactionNotFoundError,
 )
-
 from app.models.billing import TransactionRecord
 
+# Pin to one xdist worker (--dist loadgroup) so session fixtures are built once,
+# and run every test on one shared session event loop
+pytestmark = [
+    pytest.mark.xdist_group(name="billing_repo"),
+    pytest.mark.asyncio(loop_scope="session"),
+]
+
+# Opaque ids for tests that never compare them; avoids os.urandom per call
+_UUID_POOL = [uuid4() for _ in range(32)]
+_uuid_cycle = itertools.cycle(_UUID_POOL)
+
+
+def _next_uuid():
+    return next(_uuid_cycle)
+
+
+class _Chain:
+    """Query-builder stub: filter calls return itself, execute() the preset rows.
+
+    Only the builder methods the repository actually calls exist, so a typo
+    or an unexpected query shape fails with AttributeError instead of passing.
+    """
+
+    __slots__ = ("_result",)
+
+    def __init__(self, result):
+        self._result = result
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, *args, **kwargs):
+        return self
+
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def offset(self, *args, **kwargs):
+        return self
+
+    def execute(self):
+        return self._result
+
+
+class _Table:
+    """Plain-Python stand-in for a Supabase table; set rows per verb in .results"""
+
+    __slots__ = ("results",)
+
+    def __init__(self):
+        self.results = {"select": [], "insert": [], "update": [], "delete": []}
+
+    def select(self, *args, **kwargs):
+        return _Chain(self.results["select"])
+
+    def insert(self, *args, **kwargs):
+        return _Chain(self.results["insert"])
+
+    def update(self, *args, **kwargs):
+        return _Chain(self.results["update"])
+
+    def delete(self, *args, **kwargs):
+        return _Chain(self.results["delete"])
+
+
+def _make_txn(**overrides):
+    """Build a credit_transactions row dict, overriding any column"""
+    row = {
+        "id": str(_next_uuid()),
+        "user_id": str(_next_uuid()),
+        "transaction_type": "purchase",
+        "credit_amount": 100,
+        "credit_balance_after": 200,
+        "description": "Test",
+        "reference_id": None,
+        "reference_type": None,
+        "usd_amount": None,
+        "usd_per_credit": None,
+        "metadata": {},
+        "created_at": datetime.utcnow().isoformat()
+    }
+    row.update(overrides)
+    return row
+
+@pytest.fixture(scope="session")
+def base_record():
+    """Parse the shared metadata-test record once instead of per test"""
+    return TransactionRecord.from_dict(_make_txn(
+        description="Initial",
+        usd_amount=10.0,
+        usd_per_credit=0.1,
+        metadata={"a": 1}
+    ))
+
 @pytest.fixture
 def mock_table():
-    table = MagicMock()
-    return table
+    return _Table()
 
 @pytest.fixture
 def repo(mock_table):
     return BillingRepository.create_for_testing(mock_table)
 
-@pytest.mark.asyncio
-async def test_create_transaction_success(repo):
+async def test_create_transaction_success(repo, mock_table):
     repo.find_transaction_by_reference = AsyncMock(return_value=None)
-    repo.table.insert.return_value.select.return_value.execute.return_value = [
+    mock_table.results["insert"] = [
         {
-            "id": str(uuid4()),
-            "user_id": str(uuid4()),
+            "id": str(_next_uuid()),
+            "user_id": str(_next_uuid()),
             "transaction_type": "purchase",
             "credit_amount": 100,
             "credit_balance_after": 200,
@@ -43,7 +137,7 @@ async def test_create_transaction_success(repo):
     ]
 
     txn = await repo.create_transaction(
-        user_id=uuid4(),
+        user_id=_next_uuid(),
         transaction_type="purchase",
         credit_amount=100,
         credit_balance_after=200,
@@ -54,33 +148,30 @@ async def test_create_transaction_success(repo):
     assert txn.transaction_type == "purchase"
     assert txn.credit_amount == 100
 
-@pytest.mark.asyncio
 async def test_create_transaction_duplicate_reference(repo):
     repo.find_transaction_by_reference = AsyncMock(return_value=True)
     with pytest.raises(DuplicateTransactionError):
         await repo.create_transaction(
-            user_id=uuid4(),
+            user_id=_next_uuid(),
             transaction_type="purchase",
             credit_amount=100,
             credit_balance_after=200,
             description="Test",
-            reference_id=uuid4(),
+            reference_id=_next_uuid(),
             reference_type="invoice"
         )
 
-@pytest.mark.asyncio
 async def test_create_transaction_invalid_type(repo):
     with pytest.raises(InvalidTransactionTypeError):
         await repo.create_transaction(
-            user_id=uuid4(),
+            user_id=_next_uuid(),
             transaction_type="badtype",
             credit_amount=20,
             credit_balance_after=40,
             description="Bad"
         )
 
-@pytest.mark.asyncio
-async def test_get_transaction_by_id_success(repo):
+async def test_get_transaction_by_id_success(repo, mock_table):
     txn_id = uuid4()
     user_id = uuid4()
     txn_data = {
@@ -97,18 +188,17 @@ async def test_get_transaction_by_id_success(repo):
         "metadata": {},
         "created_at": datetime.utcnow().isoformat()
     }
-    repo.table.select.return_value.eq.return_value.execute.return_value = [txn_data]
+    mock_table.results["select"] = [txn_data]
 
     result = await repo.get_transaction_by_id(txn_id)
     assert isinstance(result, TransactionRecord)
     assert result.id == txn_id
 
-@pytest.mark.asyncio
-async def test_list_transactions_for_user_basic(repo):
-    user_id = uuid4()
+async def test_list_transactions_for_user_basic(repo, mock_table):
+    user_id = _next_uuid()
     txn_data = [
         {
-            "id": str(uuid4()),
+            "id": str(_next_uuid()),
             "user_id": str(user_id),
             "transaction_type": "bonus",
             "credit_amount": 25,
@@ -122,91 +212,39 @@ async def test_list_transactions_for_user_basic(repo):
             "created_at": datetime.utcnow().isoformat()
         }
     ]
-    repo.table.select.return_value.eq.return_value.order.return_value.limit.return_value.execute.return_value = txn_data
+    mock_table.results["select"] = txn_data
 
     results = await repo.list_transactions_for_user(user_id)
     assert len(results) == 1
     assert results[0].transaction_type == "bonus"
 
-@pytest.mark.asyncio
-async def test_update_transaction_metadata_merges_correctly(repo):
-    txn_id = uuid4()
-    base_data = {
-        "id": str(txn_id),
-        "user_id": str(uuid4()),
-        "transaction_type": "purchase",
-        "credit_amount": 100,
-        "credit_balance_after": 200,
-        "description": "Initial",
-        "reference_id": None,
-        "reference_type": None,
-        "usd_amount": 10.0,
-        "usd_per_credit": 0.1,
-        "metadata": {"a": 1},
-        "created_at": datetime.utcnow().isoformat()
-    }
-    updated_data = base_data.copy()
+async def test_update_transaction_metadata_merges_correctly(repo, mock_table, base_record):
+    updated_data = base_record.to_dict()
     updated_data["metadata"] = {"a": 1, "b": 2}
 
-    repo.get_transaction_by_id = AsyncMock(return_value=TransactionRecord.from_dict(base_data))
-    repo.table.update.return_value.eq.return_value.select.return_value.execute.return_value = [updated_data]
+    repo.get_transaction_by_id = AsyncMock(return_value=base_record)
+    mock_table.results["update"] = [updated_data]
 
-    result = await repo.update_transaction_metadata(txn_id, {"b": 2})
+    result = await repo.update_transaction_metadata(base_record.id, {"b": 2})
     assert result.metadata == {"a": 1, "b": 2}
 
-@pytest.mark.asyncio
 async def test_get_transaction_by_id_not_found(repo):
-    mock_execute = AsyncMock(return_value=[])
-    mock_eq = MagicMock()
-    mock_eq.execute = mock_execute
-    repo.table.select.return_value.eq.return_value = mock_eq
+    assert await repo.get_transaction_by_id(_next_uuid()) is None
 
-    with pytest.raises(TransactionNotFoundError):
-        await repo.get_transaction_by_id(uuid4())
-
-@pytest.mark.asyncio
 async def test_list_transactions_for_user_empty_result(repo):
-    user_id = uuid4()
-    mock_execute = AsyncMock(return_value=[])
-    mock_limit = MagicMock()
-    mock_limit.execute = mock_execute
-    repo.table.select.return_value.eq.return_value.order.return_value.limit.return_value = mock_limit
-
+    user_id = _next_uuid()
     results = await repo.list_transactions_for_user(user_id)
     assert results == []
 
-@pytest.mark.asyncio
 async def test_update_transaction_metadata_transaction_not_found(repo):
-    txn_id = uuid4()
+    txn_id = _next_uuid()
     repo.get_transaction_by_id = AsyncMock(side_effect=TransactionNotFoundError("Not found"))
     with pytest.raises(TransactionNotFoundError):
         await repo.update_transaction_metadata(txn_id, {"b": 2})
 
-@pytest.mark.asyncio
-async def test_update_transaction_metadata_invalid_metadata_type(repo):
-    txn_id = uuid4()
-    base_data = {
-        "id": str(txn_id),
-        "user_id": str(uuid4()),
-        "transaction_type": "purchase",
-        "credit_amount": 100,
-        "credit_balance_after": 200,
-        "description": "Initial",
-        "reference_id": None,
-        "reference_type": None,
-        "usd_amount": 10.0,
-        "usd_per_credit": 0.1,
-        "metadata": {"a": 1},
-        "created_at": datetime.utcnow().isoformat()
-    }
-    repo.get_transaction_by_id = AsyncMock(return_value=TransactionRecord.from_dict(base_data))
-
-    mock_update = MagicMock()
-    mock_select = MagicMock()
-    mock_execute = AsyncMock(return_value=[base_data])
-    mock_select.execute = mock_execute
-    mock_update.eq.return_value.select.return_value = mock_select
-    repo.table.update.return_value = mock_update
+async def test_update_transaction_metadata_invalid_metadata_type(repo, mock_table, base_record):
+    repo.get_transaction_by_id = AsyncMock(return_value=base_record)
+    mock_table.results["update"] = [base_record.to_dict()]
 
     with pytest.raises(TypeError):
-        await repo.update_transaction_metadata(txn_id, ["invalid", "list"])
+        await repo.update_transaction_metadata(base_record.id, ["invalid", "list"])
@@ -3,20 +3,36 @@
 Test-first driver for BillingRepository implementation.
 These tests define the credit transaction interface before the repository exists.
 """
+import threading
+
 import pytest
-from uuid import uuid4
+from uuid import UUID, uuid4
 from datetime import datetime, timedelta
 from decimal import Decimal
 from app.data.repositories.billing_repository import BillingRepository
 from app.core.exceptions import ValidationError, InsufficientCreditsError
 
+
+@pytest.fixture(scope="session")
+def ledger_repo():
+    """
+    Build the repository (and its database table handle) once per session.
+
+    Under pytest-xdist each worker process gets its own instance, and every
+    test uses fresh uuid4() user ids, so the tests can be spread across
+    workers freely; reset_ledger() covers the few global queries.
+    """
+    return BillingRepository()
+
+
 class TestBillingRepository:
     """Test-driven development for BillingRepository"""
     
     @pytest.fixture
-    def billing_repo(self):
-        """Create BillingRepository instance - this doesn't exist yet!"""
-        return BillingRepository()
+    def billing_repo(self, ledger_repo):
+        """Shared repository with its ledger rolled back after each test"""
+        yield ledger_repo
+        ledger_repo.reset_ledger()
     
     def test_create_purchase_transaction(self, billing_repo):
         """Test creating a credit purchase transaction"""
@@ -112,6 +128,22 @@ class TestBillingRepository:
             })
         
         assert "usage amount must be negative" in str(exc_info.value).lower()
+        
+        # Booleans are not credit amounts, even though bool subclasses int
+        with pytest.raises(ValidationError) as exc_info:
+            billing_repo.create_credit_transaction({
+                "user_id": str(uuid4()),
+                "amount": True,
+                "transaction_type": "bonus",
+                "description": "Test"
+            })
+        
+        assert "non-zero integer" in str(exc_info.value)
+        
+        with pytest.raises(ValidationError):
+            billing_repo.bulk_credit_operations([
+                {"user_id": str(uuid4()), "amount": True, "description": "Test"}
+            ])
     
     def test_get_user_balance(self, billing_repo):
         """Test getting user's current credit balance"""
@@ -250,6 +282,26 @@ class TestBillingRepository:
         balance = billing_repo.get_user_balance(user_id)
         assert balance == 500
     
+    def test_add_credits_metadata_is_not_indexed(self, billing_repo):
+        """Test an intent id in add_credits metadata does not claim the intent"""
+        user_id = uuid4()
+        metadata = {"stripe_payment_intent_id": "pi_bonus_meta"}
+        
+        # Retrying with the same metadata is not a duplicate
+        billing_repo.add_credits(user_id, 10, "Bonus", metadata)
+        billing_repo.add_credits(user_id, 10, "Bonus", metadata)
+        assert billing_repo.find_by_stripe_intent("pi_bonus_meta") is None
+        
+        # The real payment for that intent is still recorded as a purchase
+        result = billing_repo.process_stripe_payment({
+            "user_id": str(user_id),
+            "stripe_payment_intent_id": "pi_bonus_meta",
+            "credits_purchased": 100,
+        })
+        assert result["credits_added"] == 100
+        assert billing_repo.get_billing_summary(user_id)["total_purchased"] == 100
+        assert billing_repo.get_user_balance(user_id) == 120
+    
     def test_add_credits_validation(self, billing_repo):
         """Test validation for adding credits"""
         user_id = uuid4()
@@ -359,15 +411,13 @@ class TestBillingRepository:
             "description": "Test purchase"
         })
         
-        # Get history for today
-        today = datetime.now().date()
-        start_date = datetime.combine(today, datetime.min.time())
-        end_date = datetime.combine(today, datetime.max.time())
+        # Get history for today; plain dates cover the whole day
+        today = datetime.utcnow().date()
         
         history = billing_repo.get_transaction_history(
             user_id, 
-            start_date=start_date,
-            end_date=end_date
+            start_date=today,
+            end_date=today
         )
         
         assert len(history) == 1
@@ -375,17 +425,42 @@ class TestBillingRepository:
         
         # Get history for yesterday (should be empty)
         yesterday = today - timedelta(days=1)
-        start_date = datetime.combine(yesterday, datetime.min.time())
-        end_date = datetime.combine(yesterday, datetime.max.time())
         
         history = billing_repo.get_transaction_history(
             user_id,
-            start_date=start_date,
-            end_date=end_date
+            start_date=yesterday,
+            end_date=yesterday
         )
         
         assert len(history) == 0
     
+    def test_get_transaction_history_keyset_paging(self, billing_repo):
+        """Test paging with a (created_at, id) cursor, including shared timestamps"""
+        user_id = uuid4()
+        
+        # One batch shares a timestamp, so pages must split a tie
+        created = billing_repo.bulk_create_transactions([
+            {"user_id": str(user_id), "amount": 10, "transaction_type": "bonus", "description": f"Bonus {i}"}
+            for i in range(5)
+        ])
+        
+        seen = []
+        page = billing_repo.get_transaction_history(user_id, limit=2)
+        while page:
+            seen.extend(t["id"] for t in page)
+            last = page[-1]
+            page = billing_repo.get_transaction_history(
+                user_id, limit=2, before=(last["created_at"], last["id"])
+            )
+        
+        assert seen == [t["id"] for t in reversed(created)]
+        
+        # A cursor naming no row of this user is rejected, not skipped past
+        with pytest.raises(ValidationError):
+            billing_repo.get_transaction_history(
+                user_id, before=(created[0]["created_at"], "unknown-id")
+            )
+    
     def test_get_billing_summary(self, billing_repo):
         """Test getting billing summary for user"""
         user_id = uuid4()
@@ -480,6 +555,27 @@ class TestBillingRepository:
         assert history[0]["stripe_payment_intent_id"] == "pi_1ABC123"
         assert history[0]["amount"] == 250
     
+    def test_process_stripe_payment_is_idempotent(self, billing_repo):
+        """Test a retried Stripe webhook does not credit twice"""
+        user_id = uuid4()
+        payment_data = {
+            "user_id": str(user_id),
+            "stripe_payment_intent_id": "pi_retry",
+            "amount_paid": 9.99,
+            "currency": "USD",
+            "credits_purchased": 100,
+            "package": "starter"
+        }
+        
+        first = billing_repo.process_stripe_payment(payment_data)
+        second = billing_repo.process_stripe_payment(payment_data)
+        
+        assert second["success"] == True
+        assert second["credits_added"] == 0
+        assert second["transaction_id"] == first["transaction_id"]
+        assert billing_repo.get_user_balance(user_id) == 100
+        assert len(billing_repo.get_transaction_history(user_id)) == 1
+    
     def test_get_pending_transactions(self, billing_repo):
         """Test getting pending transactions"""
         user_id = uuid4()
@@ -581,25 +677,24 @@ class TestBillingRepository:
         assert billing_repo.get_user_balance(user1) == 140  # 100 - 10 + 50
         assert billing_repo.get_user_balance(user2) == 130  # 150 - 20
     
-    @pytest.mark.parametrize("transaction_type", ["purchase", "usage", "bonus", "refund", "adjustment"])
-    def test_valid_transaction_types(self, billing_repo, transaction_type):
+    def test_valid_transaction_types(self, billing_repo):
         """Test all valid transaction types"""
-        user_id = uuid4()
+        types = ["purchase", "usage", "bonus", "refund", "adjustment"]
         
-        # Determine amount based on type
-        if transaction_type in ["purchase", "bonus", "adjustment"]:
-            amount = 100
-        else:  # usage, refund
-            amount = -50
+        # Positive amounts add credits, negative amounts (usage, refund) remove them
+        rows = [
+            {
+                "user_id": str(uuid4()),
+                "amount": 100 if transaction_type in ["purchase", "bonus", "adjustment"] else -50,
+                "transaction_type": transaction_type,
+                "description": f"Test {transaction_type}"
+            }
+            for transaction_type in types
+        ]
         
-        result = billing_repo.create_credit_transaction({
-            "user_id": str(user_id),
-            "amount": amount,
-            "transaction_type": transaction_type,
-            "description": f"Test {transaction_type}"
-        })
+        results = billing_repo.bulk_create_transactions(rows)
         
-        assert result["transaction_type"] == transaction_type
+        assert [result["transaction_type"] for result in results] == types
     
     def test_concurrent_credit_operations(self, billing_repo):
         """Test concurrent credit operations don't cause race conditions"""
@@ -624,6 +719,30 @@ class TestBillingRepository:
         with pytest.raises(InsufficientCreditsError):
             billing_repo.deduct_credits(user_id, 50, "Should fail")
     
+    def test_threaded_deductions_keep_history_ordered(self, billing_repo):
+        """Test racing writers still leave the history in created_at order"""
+        user_id = uuid4()
+        threads, per_thread = 8, 250
+        billing_repo.add_credits(user_id, threads * per_thread, "Initial")
+        barrier = threading.Barrier(threads)
+        
+        def deduct():
+            barrier.wait()
+            for _ in range(per_thread):
+                billing_repo.deduct_credits(user_id, 1, "Threaded")
+        
+        workers = [threading.Thread(target=deduct) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        assert billing_repo.get_user_balance(user_id) == 0
+        history = billing_repo.get_transaction_history(user_id)
+        assert len(history) == threads * per_thread + 1
+        created = [t["created_at"] for t in history]
+        assert created == sorted(created, reverse=True)
+    
     def test_transaction_audit_trail(self, billing_repo):
         """Test that all transactions create proper audit trail"""
         user_id = uuid4()
@@ -636,8 +755,9 @@ class TestBillingRepository:
             "description": "Audit test"
         })
         
-        # Should have audit fields
+        # Should have audit fields; ids use the same dashed UUID form as other repositories
         assert "id" in result
+        assert str(UUID(result["id"])) == result["id"]
         assert "created_at" in result
         assert "updated_at" in result
         assert result["status"] == "completed"
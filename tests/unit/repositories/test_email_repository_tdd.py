@@ -9,13 +9,26 @@ from datetime import datetime, timedelta
 from app.data.repositories.email_repository import EmailRepository
 from app.core.exceptions import ValidationError, NotFoundError
 
+
+@pytest.fixture(scope="session")
+def shared_email_repo():
+    """
+    Build the repository once per session (once per pytest-xdist worker).
+
+    Tests use fresh uuid4() user ids, so they do not see each other's rows;
+    reset_records() covers the cross-user sweeps (stale, cleanup).
+    """
+    return EmailRepository()
+
+
 class TestEmailRepository:
     """Test-driven development for lean EmailRepository"""
     
     @pytest.fixture
-    def email_repo(self):
-        """Create EmailRepository instance - this doesn't exist yet!"""
-        return EmailRepository()
+    def email_repo(self, shared_email_repo):
+        """Shared repository with its records rolled back after each test"""
+        yield shared_email_repo
+        shared_email_repo.reset_records()
     
     def test_mark_discovered_single_email(self, email_repo):
         """Test marking a single email as discovered"""
@@ -31,6 +44,23 @@ class TestEmailRepository:
         assert "id" in result
         assert "discovered_at" in result
     
+    def test_returned_records_are_immutable_snapshots(self, email_repo):
+        """Test results keep dict-style reads but cannot change stored state"""
+        user_id = uuid4()
+        discovered = email_repo.mark_discovered(user_id, "gmail_snapshot_123")
+        
+        assert discovered.get("subject") is None
+        assert discovered.get("status") == "discovered"
+        assert "status" in discovered and "subject" not in discovered
+        with pytest.raises(KeyError):
+            discovered["subject"]
+        with pytest.raises(AttributeError):
+            discovered.status = "completed"
+        
+        email_repo.mark_processing_started(user_id, "gmail_snapshot_123")
+        assert discovered["status"] == "discovered"
+        assert email_repo.get_processing_status(user_id, "gmail_snapshot_123")["status"] == "processing"
+    
     def test_mark_discovered_multiple_emails(self, email_repo):
         """Test marking multiple emails as discovered in batch"""
         user_id = uuid4()
@@ -58,6 +88,19 @@ class TestEmailRepository:
         assert result2["id"] == result1["id"]  # Same record
         assert result2["discovered_at"] != result1["discovered_at"]  # Updated timestamp
     
+    def test_mark_discovered_idempotency_key(self, email_repo):
+        """Test a retried discovery with the same idempotency key is not counted twice"""
+        user_id = uuid4()
+        
+        first = email_repo.mark_discovered(user_id, "gmail_idem_123", idempotency_key="req-1")
+        replay = email_repo.mark_discovered(user_id, "gmail_idem_123", idempotency_key="req-1")
+        fresh = email_repo.mark_discovered(user_id, "gmail_idem_123", idempotency_key="req-2")
+        
+        assert replay == first
+        assert replay["discovery_count"] == 1
+        assert fresh["id"] == first["id"]
+        assert fresh["discovery_count"] == 2
+    
     def test_mark_discovered_validation(self, email_repo):
         """Test validation of discovery marking"""
         user_id = uuid4()
@@ -89,6 +132,35 @@ class TestEmailRepository:
         assert result["processing_started_at"] is not None
         assert result["processing_attempts"] == 1
     
+    def test_claim_for_processing_batch(self, email_repo):
+        """Test claiming several emails at once, all-or-nothing"""
+        user_id = uuid4()
+        email_repo.mark_discovered_batch(user_id, ["claim_1", "claim_2", "claim_3"])
+        email_repo.mark_processing_started(user_id, "claim_3")
+        
+        # One id already processing: nothing in the batch is claimed
+        with pytest.raises(ValidationError, match="already processing"):
+            email_repo.claim_for_processing(user_id, ["claim_1", "claim_3"])
+        assert email_repo.get_processing_status(user_id, "claim_1")["status"] == "discovered"
+        
+        results = email_repo.claim_for_processing(user_id, ["claim_1", "claim_2"])
+        
+        assert [r["message_id"] for r in results] == ["claim_1", "claim_2"]
+        assert all(r["status"] == "processing" for r in results)
+        assert all(r["processing_attempts"] == 1 for r in results)
+    
+    def test_claim_for_processing_duplicate_ids(self, email_repo):
+        """Test a repeated id rejects the batch without claiming anything"""
+        user_id = uuid4()
+        email_repo.mark_discovered(user_id, "claim_dup")
+        
+        with pytest.raises(ValidationError, match="Duplicate"):
+            email_repo.claim_for_processing(user_id, ["claim_dup", "claim_dup"])
+        
+        status = email_repo.get_processing_status(user_id, "claim_dup")
+        assert status["status"] == "discovered"
+        assert status["processing_attempts"] == 0
+    
     def test_mark_processing_completed_success(self, email_repo):
         """Test marking email processing as completed successfully"""
         user_id = uuid4()
@@ -248,6 +320,22 @@ class TestEmailRepository:
         # Should be ordered by discovered_at (oldest first for processing)
         assert unprocessed[0]["message_id"] == "msg_0"
     
+    def test_get_unprocessed_emails_keyset_paging(self, email_repo):
+        """Test paging the unprocessed queue with an (discovered_at, message_id) cursor"""
+        user_id = uuid4()
+        
+        # One batch shares a discovered_at, so the cursor must break ties
+        message_ids = [f"msg_page_{i}" for i in range(5)]
+        email_repo.mark_discovered_batch(user_id, message_ids)
+        
+        first = email_repo.get_unprocessed_emails(user_id, limit=3)
+        last = first[-1]
+        rest = email_repo.get_unprocessed_emails(
+            user_id, limit=3, after=(last["discovered_at"], last["message_id"])
+        )
+        
+        assert [e["message_id"] for e in first + rest] == message_ids
+    
     def test_get_processing_history(self, email_repo):
         """Test getting processing history for user"""
         user_id = uuid4()
@@ -297,6 +385,23 @@ class TestEmailRepository:
         assert failed[0]["message_id"] == "msg_failed"
         assert failed[0]["success"] == False
     
+    def test_get_processing_history_keyset_paging(self, email_repo):
+        """Test paging history newest-first with a (completed_at, message_id) cursor"""
+        user_id = uuid4()
+        message_ids = [f"msg_hist_page_{i}" for i in range(5)]
+        email_repo.mark_discovered_batch(user_id, message_ids)
+        for message_id in message_ids:
+            email_repo.mark_processing_started(user_id, message_id)
+            email_repo.mark_processing_completed(user_id, message_id, {"credits_used": 1})
+        
+        first = email_repo.get_processing_history(user_id, limit=3)
+        last = first[-1]
+        rest = email_repo.get_processing_history(
+            user_id, limit=3, before=(last["processing_completed_at"], last["message_id"])
+        )
+        
+        assert [e["message_id"] for e in first + rest] == message_ids[::-1]
+    
     def test_get_processing_stats(self, email_repo):
         """Test getting processing statistics for user"""
         user_id = uuid4()
@@ -346,6 +451,22 @@ class TestEmailRepository:
         assert stats["total_credits_used"] == 0
         assert stats["average_processing_time"] == 0.0
     
+    def test_get_processing_stats_refreshes_after_writes(self, email_repo):
+        """Test repeated stats reads stay correct as the user's emails change"""
+        user_id = uuid4()
+        email_repo.mark_discovered(user_id, "msg_stats_cache")
+        
+        assert email_repo.get_processing_stats(user_id)["total_pending"] == 1
+        
+        email_repo.mark_processing_started(user_id, "msg_stats_cache")
+        email_repo.mark_processing_completed(user_id, "msg_stats_cache", {"credits_used": 4})
+        stats = email_repo.get_processing_stats(user_id)
+        assert stats["total_successful"] == 1
+        assert stats["total_credits_used"] == 4
+        
+        email_repo.delete_user_email_data(user_id)
+        assert email_repo.get_processing_stats(user_id)["total_discovered"] == 0
+    
     def test_cleanup_old_records(self, email_repo):
         """Test cleaning up old processing records"""
         user_id = uuid4()
@@ -367,6 +488,26 @@ class TestEmailRepository:
         stats = email_repo.get_processing_stats(user_id)
         assert stats["total_successful"] >= 0
     
+    def test_cleanup_old_records_only_finished(self, email_repo):
+        """Test cleanup removes finished records and keeps queued or retried ones"""
+        user_id = uuid4()
+        email_repo.mark_discovered_batch(user_id, ["msg_done", "msg_failed", "msg_retry", "msg_queued"])
+        for message_id in ("msg_done", "msg_failed", "msg_retry"):
+            email_repo.mark_processing_started(user_id, message_id)
+        email_repo.mark_processing_completed(user_id, "msg_done", {"credits_used": 1})
+        email_repo.mark_processing_completed(user_id, "msg_failed", {"error": "x"}, success=False)
+        email_repo.mark_processing_completed(user_id, "msg_retry", {"error": "x"}, success=False)
+        email_repo.mark_for_retry(user_id, "msg_retry")
+        
+        # Negative retention puts the cutoff in the future: everything finished is old
+        cleaned_count = email_repo.cleanup_old_records(days=-1)
+        
+        assert cleaned_count == 2
+        assert email_repo.get_processing_status(user_id, "msg_done") is None
+        assert email_repo.get_processing_status(user_id, "msg_failed") is None
+        assert email_repo.get_processing_status(user_id, "msg_retry")["status"] == "discovered"
+        assert email_repo.get_processing_status(user_id, "msg_queued")["status"] == "discovered"
+    
     def test_bulk_mark_discovered(self, email_repo):
         """Test bulk marking multiple emails as discovered"""
         user_id = uuid4()
@@ -427,6 +568,21 @@ class TestEmailRepository:
         assert result["processing_result"]["timeout"] == True
         assert result["success"] == False
     
+    def test_timeout_stale(self, email_repo):
+        """Test finding and failing stale processing emails in one call"""
+        user_id = uuid4()
+        email_repo.mark_discovered_batch(user_id, ["msg_stuck_1", "msg_stuck_2", "msg_waiting"])
+        email_repo.claim_for_processing(user_id, ["msg_stuck_1", "msg_stuck_2"])
+        
+        # Negative age puts the cutoff in the future: every in-flight email is stale
+        timed_out = email_repo.timeout_stale(minutes=-1)
+        
+        assert sorted(e["message_id"] for e in timed_out) == ["msg_stuck_1", "msg_stuck_2"]
+        assert all(e["status"] == "failed" for e in timed_out)
+        assert all(e["processing_result"]["timeout"] for e in timed_out)
+        assert email_repo.get_stale_processing_emails(minutes=-1) == []
+        assert email_repo.get_processing_status(user_id, "msg_waiting")["status"] == "discovered"
+    
     def test_get_duplicate_message_ids(self, email_repo):
         """Test getting duplicate message IDs for deduplication"""
         user_id = uuid4()
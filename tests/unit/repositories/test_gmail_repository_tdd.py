@@ -3,19 +3,32 @@
 Test-first driver for GmailRepository implementation.
 These tests define the Gmail connection and OAuth management interface.
 """
+import threading
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime, timedelta
 from app.data.repositories.gmail_repository import GmailRepository
 from app.data.database import ValidationError, NotFoundError
 
+@pytest.fixture(scope="session")
+def shared_gmail_repo():
+    """
+    Build the repository (and its AES-GCM key) once per session.
+
+    Tests use fresh uuid4() user ids, so they do not see each other's
+    connections; reset_connections() covers the cross-user listings.
+    """
+    return GmailRepository()
+
 class TestGmailRepository:
     """Test-driven development for GmailRepository"""
     
     @pytest.fixture
-    def gmail_repo(self):
-        """Create GmailRepository instance - this doesn't exist yet!"""
-        return GmailRepository()
+    def gmail_repo(self, shared_gmail_repo):
+        """Shared repository with its connections rolled back after each test"""
+        yield shared_gmail_repo
+        shared_gmail_repo.reset_connections()
     
     @pytest.fixture
     def sample_oauth_tokens(self):
@@ -317,6 +330,24 @@ class TestGmailRepository:
         assert connections[0]["user_id"] == str(user_id)
         assert connections[0]["connection_status"] == "connected"
     
+    def test_connections_needing_refresh_follow_writes(self, gmail_repo, sample_oauth_tokens):
+        """Test the refresh sweep tracks status changes, reconnects and deletes"""
+        expiring_tokens = {**sample_oauth_tokens, "expires_in": 60}
+        soon, later, failed = uuid4(), uuid4(), uuid4()
+        gmail_repo.store_oauth_tokens(later, {**sample_oauth_tokens, "expires_in": 240})
+        gmail_repo.store_oauth_tokens(soon, expiring_tokens)
+        gmail_repo.store_oauth_tokens(failed, expiring_tokens)
+        gmail_repo.update_connection_status(failed, "error")
+        
+        connections = gmail_repo.get_connections_needing_refresh()
+        assert [conn["user_id"] for conn in connections] == [str(soon), str(later)]
+        
+        # Reconnecting with a long-lived token pushes the expiry out; deleting drops the connection
+        gmail_repo.store_oauth_tokens(soon, sample_oauth_tokens)
+        gmail_repo.delete_connection(later)
+        assert gmail_repo.get_connections_needing_refresh() == []
+        assert [conn["user_id"] for conn in gmail_repo.get_connections_by_status("error")] == [str(failed)]
+    
     def test_update_scopes(self, gmail_repo, sample_oauth_tokens):
         """Test updating Gmail API scopes"""
         user_id = uuid4()
@@ -514,6 +545,41 @@ class TestGmailRepository:
         assert history[1]["sync_type"] == "full"
         assert all(sync["status"] == "completed" for sync in history)
     
+    def test_update_sync_completion_after_reconnect(self, gmail_repo, sample_oauth_tokens):
+        """Test sync ids from a replaced connection's history no longer update"""
+        user_id = uuid4()
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        sync = gmail_repo.record_sync_attempt({
+            "user_id": str(user_id),
+            "sync_type": "full",
+            "started_at": datetime.now().isoformat(),
+            "status": "in_progress",
+        })
+        assert gmail_repo.update_sync_completion(sync["sync_id"], {"status": "completed"}) == True
+        assert gmail_repo.get_sync_history(user_id)[0]["status"] == "completed"
+        
+        # Reconnecting starts a fresh history
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        assert gmail_repo.update_sync_completion(sync["sync_id"], {"status": "failed"}) == False
+        assert gmail_repo.update_sync_completion("missing", {"status": "failed"}) == False
+    
+    def test_get_sync_history_limit_picks_newest(self, gmail_repo, sample_oauth_tokens):
+        """Test a limited history returns the newest syncs even when recorded out of order"""
+        user_id = uuid4()
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        
+        base = datetime(2024, 1, 1)
+        for hours in [3, 0, 5, 1, 4]:
+            gmail_repo.record_sync_attempt({
+                "user_id": str(user_id),
+                "sync_type": f"sync_{hours}",
+                "started_at": (base + timedelta(hours=hours)).isoformat(),
+                "status": "completed",
+            })
+        
+        history = gmail_repo.get_sync_history(user_id, limit=2)
+        assert [sync["sync_type"] for sync in history] == ["sync_5", "sync_4"]
+    
     def test_get_sync_history_with_status_filter(self, gmail_repo, sample_oauth_tokens):
         """Test getting sync history with status filter"""
         user_id = uuid4()
@@ -522,23 +588,24 @@ class TestGmailRepository:
         gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
         
         # Record sync attempts with different statuses
+        now = datetime.now().isoformat()
         sync1 = gmail_repo.record_sync_attempt({
             "user_id": str(user_id),
-            "started_at": datetime.now().isoformat(),
+            "started_at": now,
             "status": "in_progress",
             "sync_type": "full"
         })
         
         sync2 = gmail_repo.record_sync_attempt({
             "user_id": str(user_id),
-            "started_at": datetime.now().isoformat(),
+            "started_at": now,
             "status": "in_progress",
             "sync_type": "incremental"
         })
         
         # Complete only one sync
         gmail_repo.update_sync_completion(sync1["sync_id"], {
-            "completed_at": datetime.now().isoformat(),
+            "completed_at": now,
             "status": "completed",
             "messages_processed": 50
         })
@@ -581,6 +648,27 @@ class TestGmailRepository:
         assert gmail_repo.get_connection_info(user2)["connection_status"] == "error"
         assert gmail_repo.get_connection_info(user3)["connection_status"] == "disconnected"
     
+    def test_batch_update_connection_status_all_or_nothing(self, gmail_repo, sample_oauth_tokens):
+        """Test an invalid status anywhere in the batch applies none of it"""
+        user1 = uuid4()
+        user2 = uuid4()
+        gmail_repo.store_oauth_tokens(user1, sample_oauth_tokens)
+        gmail_repo.store_oauth_tokens(user2, sample_oauth_tokens)
+        
+        with pytest.raises(ValidationError):
+            gmail_repo.batch_update_connection_status([
+                {"user_id": str(user1), "status": "error"},
+                {"user_id": str(user2), "status": "bogus"},
+            ])
+        assert gmail_repo.get_connection_info(user1)["connection_status"] == "connected"
+        
+        # Unknown users are skipped, not counted
+        updated_count = gmail_repo.batch_update_connection_status([
+            {"user_id": str(user1), "status": "pending"},
+            {"user_id": str(uuid4()), "status": "pending"},
+        ])
+        assert updated_count == 1
+    
     def test_check_connection_health(self, gmail_repo, sample_oauth_tokens):
         """Test connection health check"""
         user_id = uuid4()
@@ -601,6 +689,16 @@ class TestGmailRepository:
         assert "health_score" in health
         assert 0 <= health["health_score"] <= 1
     
+    def test_check_connection_health_bulk(self, gmail_repo, sample_oauth_tokens):
+        """Test bulk health checks report connected users and skip unknown ones"""
+        user1, user2 = uuid4(), uuid4()
+        gmail_repo.store_oauth_tokens(user1, sample_oauth_tokens)
+        gmail_repo.store_oauth_tokens(user2, sample_oauth_tokens)
+        
+        reports = gmail_repo.check_connection_health_bulk([user1, uuid4(), user2])
+        assert [report["user_id"] for report in reports] == [str(user1), str(user2)]
+        assert all(report["token_valid"] for report in reports)
+    
     def test_check_connection_health_no_connection(self, gmail_repo):
         """Test health check when no connection exists"""
         user_id = uuid4()
@@ -624,6 +722,48 @@ class TestGmailRepository:
         assert retrieved_tokens["access_token"] == sample_oauth_tokens["access_token"]
         assert retrieved_tokens["refresh_token"] == sample_oauth_tokens["refresh_token"]
     
+    def test_rotate_encryption_key_keeps_other_users_readable(self, gmail_repo, sample_oauth_tokens):
+        """Test rotating one user's key leaves other users' tokens decryptable"""
+        rotated_user, other_user = uuid4(), uuid4()
+        gmail_repo.store_oauth_tokens(rotated_user, sample_oauth_tokens)
+        gmail_repo.store_oauth_tokens(other_user, sample_oauth_tokens)
+        
+        assert gmail_repo.rotate_encryption_key(rotated_user) == True
+        assert gmail_repo.rotate_encryption_key(rotated_user) == True
+        
+        assert gmail_repo.get_oauth_tokens(other_user) == sample_oauth_tokens
+        assert gmail_repo.get_oauth_tokens(rotated_user) == sample_oauth_tokens
+        
+        # Writes after rotation use the new key and still round-trip
+        new_tokens = gmail_repo.refresh_access_token(other_user)
+        assert gmail_repo.get_oauth_tokens(other_user)["access_token"] == new_tokens["access_token"]
+    
+    def test_token_cache_follows_writes(self, gmail_repo, sample_oauth_tokens):
+        """Test cached token reads reflect refreshes and deletes"""
+        user_id = uuid4()
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        
+        assert gmail_repo.get_oauth_tokens(user_id) == sample_oauth_tokens
+        assert gmail_repo.get_oauth_tokens(user_id) == sample_oauth_tokens
+        
+        new_tokens = gmail_repo.refresh_access_token(user_id)
+        assert gmail_repo.get_oauth_tokens(user_id)["access_token"] == new_tokens["access_token"]
+        
+        assert gmail_repo.delete_connection(user_id) == True
+        assert gmail_repo.get_oauth_tokens(user_id) is None
+    
+    def test_sealed_tokens_round_trip_any_text(self, gmail_repo, sample_oauth_tokens):
+        """Test tokens with separators and non-ASCII text survive sealing"""
+        user_id = uuid4()
+        tokens = {**sample_oauth_tokens, "access_token": 'a"\x00,é', "refresh_token": "]ü[\n"}
+        gmail_repo.store_oauth_tokens(user_id, tokens)
+        
+        # Force a real decrypt rather than a token-cache hit
+        gmail_repo._token_cache.clear()
+        stored_tokens = gmail_repo.get_oauth_tokens(user_id)
+        assert stored_tokens["access_token"] == tokens["access_token"]
+        assert stored_tokens["refresh_token"] == tokens["refresh_token"]
+    
     def test_rotate_encryption_key_no_connection(self, gmail_repo):
         """Test rotating encryption key when no connection exists"""
         user_id = uuid4()
@@ -719,22 +859,23 @@ class TestGmailRepository:
         gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
         
         # Log various activities
+        now = datetime.now().isoformat()
         activities = [
             {
                 "activity_type": "token_refresh",
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": now,
                 "success": True,
                 "details": {"new_expires_in": 3600}
             },
             {
                 "activity_type": "api_call",
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": now,
                 "success": True,
                 "details": {"endpoint": "messages/list", "response_time": 0.5}
             },
             {
                 "activity_type": "sync_operation",
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": now,
                 "success": False,
                 "details": {"error": "quota_exceeded", "retry_after": 60}
             }
@@ -754,6 +895,23 @@ class TestGmailRepository:
         assert "api_call" in activity_types
         assert "sync_operation" in activity_types
     
+    def test_connection_activity_logging_bulk(self, gmail_repo, sample_oauth_tokens):
+        """Test logging several activities in one call"""
+        user_id = uuid4()
+        activities = [
+            {"activity_type": "api_call", "success": True, "details": {"n": n}}
+            for n in range(3)
+        ]
+        
+        # Nothing is logged without a connection
+        assert gmail_repo.log_connection_activity_bulk(user_id, activities) == 0
+        
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        assert gmail_repo.log_connection_activity_bulk(user_id, activities) == 3
+        
+        activity_log = gmail_repo.get_connection_activity_log(user_id, limit=10)
+        assert [activity["details"]["n"] for activity in activity_log] == [0, 1, 2]
+    
     def test_connection_cleanup_on_user_deletion(self, gmail_repo, sample_oauth_tokens):
         """Test that connection is cleaned up when user is deleted"""
         user_id = uuid4()
@@ -782,21 +940,20 @@ class TestGmailRepository:
         # Store tokens first
         gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
         
-        # Record multiple sync operations
-        for i in range(5):
-            sync_record = gmail_repo.record_sync_attempt({
-                "user_id": str(user_id),
-                "started_at": datetime.now().isoformat(),
-                "status": "in_progress",
-                "sync_type": "incremental"
-            })
-            
-            gmail_repo.update_sync_completion(sync_record["sync_id"], {
-                "completed_at": datetime.now().isoformat(),
+        # Record multiple completed sync operations in one call
+        now = datetime.now().isoformat()
+        sync_records = gmail_repo.record_sync_attempts_bulk(user_id, [
+            {
+                "started_at": now,
+                "completed_at": now,
                 "status": "completed",
+                "sync_type": "incremental",
                 "messages_processed": 10 + i,
                 "duration": 2.0 + (i * 0.5)
-            })
+            }
+            for i in range(5)
+        ])
+        assert len({sync["sync_id"] for sync in sync_records}) == 5
         
         # Get aggregated stats
         stats = gmail_repo.get_connection_stats(user_id)
@@ -806,24 +963,92 @@ class TestGmailRepository:
         assert stats["failed_syncs"] == 0
         assert stats["average_sync_time"] > 0
         assert stats["connection_uptime"] > 0
+        
+        # Bulk recording needs a connection like single recording does
+        with pytest.raises(NotFoundError):
+            gmail_repo.record_sync_attempts_bulk(uuid4(), [{"status": "completed"}])
+    
+    def test_connection_stats_follow_sync_writes(self, gmail_repo, sample_oauth_tokens):
+        """Test repeated stats reads pick up syncs recorded and completed in between"""
+        user_id = uuid4()
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        assert gmail_repo.get_connection_stats(user_id)["successful_syncs"] == 0
+        
+        sync = gmail_repo.record_sync_attempt({
+            "user_id": str(user_id),
+            "started_at": datetime.now().isoformat(),
+            "status": "in_progress",
+        })
+        stats = gmail_repo.get_connection_stats(user_id)
+        assert (stats["successful_syncs"], stats["failed_syncs"]) == (0, 1)
+        
+        gmail_repo.update_sync_completion(sync["sync_id"], {"status": "completed", "messages_processed": 7})
+        stats = gmail_repo.get_connection_stats(user_id)
+        assert (stats["successful_syncs"], stats["failed_syncs"]) == (1, 0)
+        assert stats["total_emails_processed"] == 7
+        
+        # Reconnecting starts a fresh history
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        assert gmail_repo.get_connection_stats(user_id)["total_emails_processed"] == 0
+    
+    def test_refresh_access_token_idempotency_key(self, gmail_repo, sample_oauth_tokens):
+        """Test retrying a refresh with the same idempotency key does not refresh again"""
+        user_id = uuid4()
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        
+        first = gmail_repo.refresh_access_token(user_id, idempotency_key="refresh-1")
+        retry = gmail_repo.refresh_access_token(user_id, idempotency_key="refresh-1")
+        assert retry == first
+        assert gmail_repo.get_oauth_tokens(user_id)["access_token"] == first["access_token"]
+        
+        # A new key (or no key) refreshes as usual
+        second = gmail_repo.refresh_access_token(user_id, idempotency_key="refresh-2")
+        assert second["access_token"] != first["access_token"]
+        assert gmail_repo.refresh_access_token(user_id)["access_token"] != second["access_token"]
+    
+    def test_refresh_access_token_losing_race_returns_winner(self, gmail_repo, sample_oauth_tokens, monkeypatch):
+        """Test a refresh overtaken by another refresh returns the winner's token"""
+        user_id = uuid4()
+        gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
+        
+        # Let a second refresh complete between the first one's read and write
+        read_tokens = gmail_repo._tokens_for
+        winners = []
+        def racing_read(key, conn):
+            tokens = read_tokens(key, conn)
+            monkeypatch.setattr(gmail_repo, "_tokens_for", read_tokens)
+            winners.append(gmail_repo.refresh_access_token(user_id))
+            return tokens
+        monkeypatch.setattr(gmail_repo, "_tokens_for", racing_read)
+        
+        loser = gmail_repo.refresh_access_token(user_id)
+        
+        assert loser["access_token"] == winners[0]["access_token"]
+        stored_tokens = gmail_repo.get_oauth_tokens(user_id)
+        assert stored_tokens["access_token"] == winners[0]["access_token"]
+        assert stored_tokens["refresh_token"] == sample_oauth_tokens["refresh_token"]
     
-    def test_concurrent_token_operations(self, gmail_repo, sample_oauth_tokens):
+    @pytest.mark.parametrize("workers", [2, 8])
+    def test_concurrent_token_operations(self, gmail_repo, sample_oauth_tokens, workers):
         """Test concurrent token operations don't cause race conditions"""
         user_id = uuid4()
         
         # Store initial tokens
         gmail_repo.store_oauth_tokens(user_id, sample_oauth_tokens)
         
-        # Simulate concurrent refresh attempts
-        # In real implementation, this would test database-level atomicity
-        success1 = gmail_repo.refresh_access_token(user_id)
-        success2 = gmail_repo.refresh_access_token(user_id)
+        # Fire the refreshes from parallel threads, released together
+        start = threading.Barrier(workers)
+        def refresh():
+            start.wait()
+            return gmail_repo.refresh_access_token(user_id)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [f.result() for f in [executor.submit(refresh) for _ in range(workers)]]
         
-        # Both should succeed or one should fail gracefully
-        assert success1 is not None or success2 is not None
+        # Every refresh succeeds, and each hands out a token that was stored
+        assert all(result is not None for result in results)
         
-        # Final state should be consistent
+        # Final state should be consistent: the stored token is one that was handed out
         final_tokens = gmail_repo.get_oauth_tokens(user_id)
         assert final_tokens is not None
-        assert "access_token" in final_tokens
-        assert "refresh_token" in final_tokens
\ No newline at end of file
+        assert final_tokens["access_token"] in {result["access_token"] for result in results}
+        assert final_tokens["refresh_token"] == sample_oauth_tokens["refresh_token"]
\ No newline at end of file
@@ -3,7 +3,9 @@
 Test-first driver for JobRepository implementation.
 Manages background job queue for email processing.
 """
+import threading
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime, timedelta
 from app.data.repositories.job_repository import JobRepository
@@ -171,6 +173,26 @@ class TestJobRepository:
         assert pending[1]["priority"] == "normal"
         assert pending[2]["priority"] == "low"
     
+    def test_pending_jobs_follow_claims_and_retries(self, job_repo):
+        """Test the pending queue drops claimed jobs and picks retried ones back up"""
+        user_id = uuid4()
+        past = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+        high = job_repo.create_job({"user_id": str(user_id), "job_type": "email_processing",
+                                    "priority": "high", "scheduled_for": past})
+        low = job_repo.create_job({"user_id": str(user_id), "job_type": "email_processing",
+                                   "priority": "low", "scheduled_for": past})
+        
+        job_repo.claim_job(high["id"], "worker_1")
+        assert [job["id"] for job in job_repo.get_pending_jobs(limit=5)] == [low["id"]]
+        
+        # A failed job retried with no delay is ready again, ahead of lower priorities
+        job_repo.mark_job_failed(high["id"], {"error": "transient"})
+        job_repo.retry_job(high["id"], timedelta(0))
+        assert [job["id"] for job in job_repo.get_pending_jobs(limit=1)] == [high["id"]]
+        
+        assert job_repo.delete_user_jobs(user_id) == 2
+        assert job_repo.get_pending_jobs() == []
+    
     def test_claim_job_for_processing(self, job_repo):
         """Test claiming a job for processing"""
         user_id = uuid4()
@@ -726,6 +748,30 @@ class TestJobRepository:
         
         assert "job already claimed" in str(exc_info.value).lower()
     
+    def test_concurrent_job_claiming_threads(self, job_repo):
+        """Test exactly one of several parallel workers claims a job"""
+        job = job_repo.create_job({
+            "user_id": str(uuid4()),
+            "job_type": "email_processing"
+        })
+        
+        workers = 8
+        start = threading.Barrier(workers)
+        def claim(worker_id):
+            start.wait()
+            try:
+                return job_repo.claim_job(job["id"], worker_id)
+            except ValidationError:
+                return None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            claims = list(executor.map(claim, [f"worker_{n}" for n in range(workers)]))
+        
+        winners = [claimed for claimed in claims if claimed is not None]
+        assert len(winners) == 1
+        job_status = job_repo.get_job_status(job["id"])
+        assert job_status["worker_id"] == winners[0]["worker_id"]
+        assert job_status["attempts"] == 1
+    
     def test_job_queue_ordering(self, job_repo):
         """Test job queue ordering by priority and schedule"""
         user_id = uuid4()
@@ -195,11 +195,18 @@ async def test_add_promotional_credits(service, mock_user_repo, mock_billing_rep
     user_id = uuid4()
     mock_user_repo.get_user_profile.return_value = {'credits_remaining': 5}
     txn = {'transaction_type': 'bonus', 'credit_amount': 20}
-    mock_billing_repo.add_credits.return_value = txn
+    mock_billing_repo.create_transaction.return_value = txn
     mock_user_repo.add_credits.return_value = None
 
     res = await service.add_promotional_credits(user_id, 20, 'promo')
-    mock_billing_repo.add_credits.assert_awaited_once()
+    mock_billing_repo.create_transaction.assert_awaited_once_with(
+        user_id=user_id,
+        transaction_type='bonus',
+        credit_amount=20,
+        credit_balance_after=25,
+        description='promo',
+        metadata={'source': 'promotion', 'note': 'promo'}
+    )
     mock_user_repo.add_credits.assert_called_once_with(str(user_id), 20, 'promo')
     mock_audit_repo.log_event.assert_awaited_once_with(str(user_id), 'promotional_credits_added', {'credits': 20})
     assert res == txn
@@ -216,11 +223,18 @@ async def test_deduct_manual_credits(service, mock_user_repo, mock_billing_repo,
     user_id = uuid4()
     mock_user_repo.get_user_profile.return_value = {'credits_remaining': 50}
     txn = {'transaction_type': 'adjustment', 'credit_amount': -10}
-    mock_billing_repo.deduct_credits.return_value = txn
+    mock_billing_repo.create_transaction.return_value = txn
     mock_user_repo.deduct_credits.return_value = None
 
     res = await service.deduct_manual_credits(user_id, 10, 'adj')
-    mock_billing_repo.deduct_credits.assert_awaited_once()
+    mock_billing_repo.create_transaction.assert_awaited_once_with(
+        user_id=user_id,
+        transaction_type='adjustment',
+        credit_amount=-10,
+        credit_balance_after=40,
+        description='adj',
+        metadata={'source': 'admin', 'reason': 'adj'}
+    )
     mock_user_repo.deduct_credits.assert_called_once_with(str(user_id), 10, 'adj')
     mock_audit_repo.log_event.assert_awaited_once_with(str(user_id), 'manual_credits_deducted', {'credits': 10})
     assert res == txn